@@ -1,9 +1,13 @@
 # coding: utf-8
 # copyright by codeskyblue of openATX
 
+import asyncio
 import os
+import struct
 import subprocess
-from collections import namedtuple
+import time
+from collections import namedtuple, defaultdict
+from contextlib import asynccontextmanager
 
 import tornado.iostream
 from logzero import logger
@@ -18,6 +22,20 @@ FAIL = "FAIL"
 DeviceItem = namedtuple("Device", ['serial', 'status'])
 DeviceEvent = namedtuple('DeviceEvent', ['present', 'serial', 'status'])
 ForwardItem = namedtuple("ForwardItem", ['serial', 'local', 'remote'])
+SyncStat = namedtuple("SyncStat", ['mode', 'size', 'mtime'])
+ShellResult = namedtuple("ShellResult", ['stdout', 'stderr', 'exit_code'])
+
+# shell v2协议的数据包类型
+SHELL_V2_STDOUT = 1
+SHELL_V2_STDERR = 2
+SHELL_V2_EXIT = 3
+# 不支持shell v2时 在输出末尾追加退出码
+SHELL_EXIT_MARKER = b"__LM_EXIT__:"
+
+# sync协议单个DATA包的最大长度
+SYNC_DATA_MAX = 64 * 1024
+# 普通文件类型 SEND时与权限一起发送
+S_IFREG = 0o100000
 
 
 class AdbError(Exception):
@@ -50,6 +68,9 @@ class AdbStreamConnection(tornado.iostream.IOStream):
     async def read_exactly(self, num:int):
         return await self.stream.read_bytes(num)
 
+    async def read_partial(self, max_bytes: int):
+        return await self.stream.read_bytes(max_bytes, partial=True)
+
     async def read_bytes_until(self, delimiter: bytes, max_bytes: int):
         return await self.stream.read_until(delimiter, max_bytes)
 
@@ -58,6 +79,14 @@ class AdbStreamConnection(tornado.iostream.IOStream):
         msgsize = int(lenstr, 16)
         return (await self.read_exactly(msgsize)).decode()
 
+    async def send_sync(self, cmd: str, data: bytes):
+        await self.stream.write(cmd.encode('utf-8') + struct.pack("<I", len(data)) + data)
+
+    async def read_sync(self):
+        """读取sync协议响应 返回(id, length)"""
+        header = await self.read_exactly(8)
+        return header[:4].decode('utf-8'), struct.unpack("<I", header[4:])[0]
+
     async def check_okay(self):
         data = (await self.read_exactly(4)).decode()
         if data == FAIL:
@@ -67,6 +96,9 @@ class AdbStreamConnection(tornado.iostream.IOStream):
         else:
             raise AdbError("Unknown data: %s" % data)
 
+    def closed(self) -> bool:
+        return self.__stream is None or self.__stream.closed()
+
     async def connect(self):
         stream = await TCPClient().connect(self.__host, self.__port)
         self.__stream = stream
@@ -84,15 +116,125 @@ class AdbStreamConnection(tornado.iostream.IOStream):
         self.stream.close()
 
 
+class LatencyStat(object):
+    """单类命令的耗时统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
 class AdbClient(object):
+    """
+    adb server每个连接只处理一个host服务或transport服务 处理完即关闭 所以连接不能复用
+    这里预先建立少量空闲连接 请求时直接取用省去建连耗时 同时限制每台设备并发的transport数
+    """
 
-    def connect(self, host="127.0.0.1", port=5037) -> AdbStreamConnection:
-        return AdbStreamConnection(host, port)
+    def __init__(self, host="127.0.0.1", port=5037, pool_size=2, max_transports=4, slow_threshold=1.0,
+                 listen_all=False):
+        self._host = host
+        self._port = port
+        self._pool_size = pool_size
+        self._max_transports = max_transports
+        self._slow_threshold = slow_threshold
+        self._idle = []
+        self._filling = 0
+        self._transport_limits = dict()
+        self._features = dict()
+        self.latency = defaultdict(LatencyStat)
+        # 重启adb server时监听所有网卡(adb -a) 端口转发可直接对外暴露
+        self.listen_all = listen_all
+
+    def connect(self, host=None, port=None) -> AdbStreamConnection:
+        return AdbStreamConnection(host or self._host, port or self._port)
+
+    async def _open(self, pooled=True) -> AdbStreamConnection:
+        conn = None
+        while pooled and self._idle:
+            candidate = self._idle.pop()
+            if not candidate.closed():
+                conn = candidate
+                break
+        if conn is None:
+            conn = await self.connect().connect()
+        self._fill_pool()
+        return conn
+
+    def _fill_pool(self):
+        while len(self._idle) + self._filling < self._pool_size:
+            self._filling += 1
+            asyncio.ensure_future(self._add_idle())
+
+    async def _add_idle(self):
+        try:
+            self._idle.append(await self.connect().connect())
+        except Exception as e:
+            logger.debug("adb pool connect error: %s", e)
+        finally:
+            self._filling -= 1
+
+    def _transport_limit(self, serial: str) -> asyncio.Semaphore:
+        if serial not in self._transport_limits:
+            self._transport_limits[serial] = asyncio.Semaphore(self._max_transports)
+        return self._transport_limits[serial]
+
+    @asynccontextmanager
+    async def session(self, name: str, cmd: str, serial: str = None):
+        """
+        发送首个请求并确认OKAY 返回连接 结束后关闭连接并记录耗时
+        池中连接可能已被adb server关闭 此时改用新连接重试一次
+        serial: 需要切换到设备transport时传入 受每台设备并发数限制
+        """
+        limit = self._transport_limit(serial) if serial else None
+        start = time.time()
+        if limit:
+            await limit.acquire()
+        conn = None
+        try:
+            for pooled in (True, False):
+                conn = await self._open(pooled)
+                try:
+                    await conn.send_cmd(cmd)
+                    await conn.check_okay()
+                    break
+                except tornado.iostream.StreamClosedError:
+                    await conn.disconnect()
+                    if not pooled:
+                        raise
+            yield conn
+        finally:
+            if conn:
+                await conn.disconnect()
+            if limit:
+                limit.release()
+            cost = time.time() - start
+            self.latency[name].add(cost)
+            if cost > self._slow_threshold:
+                logger.debug("adb %s %s cost %.3fs", name, serial or "", cost)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await conn.disconnect()
+
+    def latency_report(self) -> dict:
+        return {name: stat.as_dict() for name, stat in self.latency.items()}
 
     async def server_version(self) -> int:
-        async with self.connect() as c:
-            await c.send_cmd("host:version")
-            await c.check_okay()
+        async with self.session("version", "host:version") as c:
             return int(await c.read_string(), 16)
 
     async def track_devices(self):
@@ -123,7 +265,7 @@ class AdbClient(object):
                 logger.info(
                     "adb connection is down, retry after %.1fs" % sleep)
                 await gen.sleep(sleep)
-                subprocess.run(['adb', 'start-server'])
+                subprocess.run(['adb', '-a', 'start-server'] if self.listen_all else ['adb', 'start-server'])
                 version = await self.server_version()
                 logger.info("adb-server started, version: %d", version)
 
@@ -137,6 +279,7 @@ class AdbClient(object):
     def _diff_devices(self, orig_devices: list, curr_devices: list):
         """ Return iter(DeviceEvent) """
         for d in set(orig_devices).difference(curr_devices):
+            self._features.pop(d.serial, None)
             yield DeviceEvent(False, d.serial, d.status)
         for d in set(curr_devices).difference(orig_devices):
             yield DeviceEvent(True, d.serial, d.status)
@@ -164,19 +307,169 @@ class AdbClient(object):
         return results
 
     async def shell(self, serial: str, command: str):
-        async with self.connect() as conn:
-            await conn.send_cmd("host:transport:"+serial)
-            await conn.check_okay()
+        async with self.session("shell", "host:transport:"+serial, serial) as conn:
             await conn.send_cmd("shell:"+command)
             await conn.check_okay()
             output = await conn.stream.read_until_close()
             return output.decode('utf-8')
 
-    async def forward_list(self):
-        async with self.connect() as conn:
-            # adb 1.0.40 not support host-local
-            await conn.send_cmd("host:list-forward")
+    async def exec_out(self, serial: str, command: str) -> bytes:
+        """exec服务不分配pty 输出为原始二进制 适用于screencap等"""
+        async with self.session("exec", "host:transport:"+serial, serial) as conn:
+            await conn.send_cmd("exec:"+command)
+            await conn.check_okay()
+            return await conn.stream.read_until_close()
+
+    async def iter_shell(self, serial: str, command: str, lines=False):
+        """
+        流式读取shell输出 适用于logcat等长时间或大量输出的命令
+        lines: True时按行输出(不含换行符) 否则按收到的数据块输出
+        """
+        async with self.session("shell", "host:transport:"+serial, serial) as conn:
+            await conn.send_cmd("shell:"+command)
             await conn.check_okay()
+            pending = b""
+            while True:
+                try:
+                    chunk = await conn.read_partial(SYNC_DATA_MAX)
+                except tornado.iostream.StreamClosedError:
+                    break
+                if not lines:
+                    yield chunk
+                    continue
+                pending += chunk
+                *complete, pending = pending.split(b"\n")
+                for line in complete:
+                    yield line.rstrip(b"\r")
+            if lines and pending:
+                yield pending.rstrip(b"\r")
+
+    async def features(self, serial: str) -> set:
+        if serial not in self._features:
+            async with self.session("features", "host-serial:%s:features" % serial) as conn:
+                self._features[serial] = set((await conn.read_string()).split(","))
+        return self._features[serial]
+
+    async def iter_shell_v2(self, serial: str, command: str):
+        """
+        shell v2协议 区分stdout和stderr
+        yield (SHELL_V2_STDOUT|SHELL_V2_STDERR, data) 最后yield (SHELL_V2_EXIT, exit_code)
+        """
+        async with self.session("shell", "host:transport:"+serial, serial) as conn:
+            await conn.send_cmd("shell,v2,raw:"+command)
+            await conn.check_okay()
+            while True:
+                header = await conn.read_exactly(5)
+                packet_id, length = header[0], struct.unpack("<I", header[1:])[0]
+                data = await conn.read_exactly(length)
+                if packet_id == SHELL_V2_EXIT:
+                    yield SHELL_V2_EXIT, data[0]
+                    return
+                if packet_id in (SHELL_V2_STDOUT, SHELL_V2_STDERR):
+                    yield packet_id, data
+
+    async def shell_v2(self, serial: str, command: str) -> ShellResult:
+        """执行命令并返回退出码 设备不支持shell v2时stderr合并到stdout"""
+        if "shell_v2" not in await self.features(serial):
+            output = b"".join([chunk async for chunk in self.iter_shell(
+                serial, "%s; echo %s$?" % (command, SHELL_EXIT_MARKER.decode()))])
+            output, marker, code = output.rpartition(SHELL_EXIT_MARKER)
+            exit_code = int(code.strip()) if marker and code.strip().isdigit() else -1
+            return ShellResult(output.decode('utf-8'), "", exit_code)
+        stdout, stderr, exit_code = [], [], None
+        async for packet_id, data in self.iter_shell_v2(serial, command):
+            if packet_id == SHELL_V2_STDOUT:
+                stdout.append(data)
+            elif packet_id == SHELL_V2_STDERR:
+                stderr.append(data)
+            else:
+                exit_code = data
+        return ShellResult(b"".join(stdout).decode('utf-8'), b"".join(stderr).decode('utf-8'), exit_code)
+
+    @asynccontextmanager
+    async def sync(self, serial: str):
+        """进入设备的sync模式"""
+        async with self.session("sync", "host:transport:"+serial, serial) as conn:
+            await conn.send_cmd("sync:")
+            await conn.check_okay()
+            yield conn
+
+    async def stat(self, serial: str, path: str) -> SyncStat:
+        async with self.sync(serial) as conn:
+            await conn.send_sync("STAT", path.encode('utf-8'))
+            data = await conn.read_exactly(16)
+            if data[:4] != b"STAT":
+                raise AdbError("Unknown data: %s" % data[:4])
+            return SyncStat(*struct.unpack("<III", data[4:]))
+
+    async def push(self, serial: str, src, dest: str, mode=0o755, total: int = None, progress=None) -> int:
+        """
+        推送文件到设备 按64KB分块读取 取消任务即中断推送
+        Args:
+            src: 本地文件路径或可读的文件对象(如zip成员)
+            total: 文件总大小 用于进度回调 传入路径时自动获取
+            progress: 回调函数 progress(sent, total)
+        Returns:
+            发送的字节数
+        """
+        if isinstance(src, str):
+            total = os.path.getsize(src)
+            with open(src, "rb") as f:
+                return await self.push(serial, f, dest, mode, total, progress)
+        sent = 0
+        async with self.sync(serial) as conn:
+            await conn.send_sync("SEND", "{},{}".format(dest, S_IFREG | mode).encode('utf-8'))
+            while True:
+                chunk = src.read(SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                await conn.send_sync("DATA", chunk)
+                sent += len(chunk)
+                if progress:
+                    progress(sent, total)
+            await conn.stream.write(b"DONE" + struct.pack("<I", int(time.time())))
+            result, length = await conn.read_sync()
+            if result == FAIL:
+                raise AdbError((await conn.read_exactly(length)).decode('utf-8'))
+            if result != OKAY:
+                raise AdbError("Unknown data: %s" % result)
+        return sent
+
+    async def iter_content(self, serial: str, path: str):
+        """分块读取设备上的文件"""
+        async with self.sync(serial) as conn:
+            await conn.send_sync("RECV", path.encode('utf-8'))
+            while True:
+                result, length = await conn.read_sync()
+                if result == "DATA":
+                    yield await conn.read_exactly(length)
+                elif result == "DONE":
+                    break
+                elif result == FAIL:
+                    raise AdbError((await conn.read_exactly(length)).decode('utf-8'))
+                else:
+                    raise AdbError("Unknown data: %s" % result)
+
+    async def pull(self, serial: str, src: str, dest: str) -> int:
+        """拉取设备文件到本地 返回字节数"""
+        size = 0
+        part = dest + ".part"
+        try:
+            with open(part, "wb") as f:
+                async for chunk in self.iter_content(serial, src):
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            # 传输失败或被取消时删除不完整的文件
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        os.replace(part, dest)
+        return size
+
+    async def forward_list(self):
+        # adb 1.0.40 not support host-local
+        async with self.session("list-forward", "host:list-forward") as conn:
             content = await conn.read_string()
             for line in content.splitlines():
                 parts = line.split()
@@ -192,13 +485,21 @@ class AdbClient(object):
             norebind(bool): set to true will fail it when 
                     there is already a forward connection from <local>
         """
-        async with self.connect() as conn:
-            cmds = ["host-serial", serial, "forward"]
-            if norebind:
-                cmds.append('norebind')
-            cmds.append(local+";"+remote)
-            await conn.send_cmd(":".join(cmds))
-            await conn.check_okay()
+        cmds = ["host-serial", serial, "forward"]
+        if norebind:
+            cmds.append('norebind')
+        cmds.append(local+";"+remote)
+        async with self.session("forward", ":".join(cmds)):
+            pass
+
+    async def forward_remove(self, serial: str, local: str):
+        """移除设备的一个端口转发 local: tcp:<port>"""
+        async with self.session("killforward", "host-serial:%s:killforward:%s" % (serial, local)):
+            pass
+
+    async def device_list(self) -> list:
+        async with self.session("devices", "host:devices") as conn:
+            return self.output2devices(await conn.read_string(), limit_status=['device'])
 
 
 adb = AdbClient()
@@ -0,0 +1,199 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+# screencap基准需要以包的方式导入android和tools
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_port import RelayManager
+from proxy_scrcpy import dispatch_control
+from scrcpy.controller import Controller
+
+
+class _NullSocket:
+    """丢弃所有写入的control_socket"""
+
+    def __init__(self):
+        self.written = 0
+
+    async def write_bytes(self, msg: bytes):
+        self.written += len(msg)
+
+
+class _FakeDevice:
+    def __init__(self, resolution=(1080, 2340)):
+        self.resolution = resolution
+        self.device_lock = asyncio.Lock()
+        self.control_socket = _NullSocket()
+
+
+async def _run_control(messages: list, inject) -> tuple:
+    """返回(耗时, 合并的move数, 写入字节数) 每个场景使用新的Controller"""
+    device = _FakeDevice()
+    controller = Controller(device)
+    start = time.perf_counter()
+    for msg in messages:
+        await inject(controller, msg)
+    await controller.flush()
+    cost = time.perf_counter() - start
+    controller.close()
+    return cost, controller.coalesced, device.control_socket.written
+
+
+async def _inject_json(controller, text):
+    # 与/touch收到文本消息时的处理一致
+    await dispatch_control(controller, json.loads(text))
+
+
+async def _inject_binary(controller, msg):
+    await controller.inject_binary(msg)
+
+
+async def bench_control(count: int, serial: str = None):
+    """
+    对比/touch的json和二进制两种消息每秒可处理的事件数
+    unmerged: down和move交替 消息不会被合并 衡量完整的解析和写入开销
+    merged: 连续move 积压的move只保留最新一条
+    json消息没有触点id 两种消息都使用默认触点-1
+    """
+    width, height = _FakeDevice().resolution
+    scenarios = {
+        "unmerged": lambda i: i % 2 * 2,
+        "merged": lambda i: 2,
+    }
+    for scenario, action in scenarios.items():
+        json_messages = [json.dumps({"msg_type": 2, "action": action(i), "x": i % 1000 / 1000, "y": 0.5})
+                         for i in range(count)]
+        binary_messages = [struct.pack(">BBqiiHHHi", 2, action(i), -1, i % width, height // 2,
+                                       width, height, 0xFFFF, 1) for i in range(count)]
+        for name, messages, inject in (("json", json_messages, _inject_json),
+                                       ("binary", binary_messages, _inject_binary)):
+            cost, coalesced, written = await _run_control(messages, inject)
+            print("control %-8s %-6s: %10.0f events/s  coalesced %7d  written %9d bytes" % (
+                scenario, name, count / cost, coalesced, written))
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """模拟adb转发端口 原样返回收到的数据"""
+    while True:
+        data = await reader.read(64 * 1024)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def _measure_port(port: int, count: int, size: int) -> tuple:
+    """返回(往返延迟秒数列表, 吞吐MB/s)"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(b"p")
+        await writer.drain()
+        await reader.readexactly(1)
+        latencies.append(time.perf_counter() - start)
+
+    chunk = b"x" * (64 * 1024)
+
+    async def send():
+        for _ in range(size // len(chunk)):
+            writer.write(chunk)
+            await writer.drain()
+
+    start = time.perf_counter()
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while received < size // len(chunk) * len(chunk):
+        received += len(await reader.read(256 * 1024))
+    await sender
+    throughput = received / (time.perf_counter() - start) / 1024 / 1024
+    writer.close()
+    await writer.wait_closed()
+    # 等待EOF经relay传到echo端
+    await asyncio.sleep(0.1)
+    return latencies, throughput
+
+
+async def bench_forward(count: int, serial: str = None):
+    """对比直接访问adb转发端口(direct)和经relay转发两种方式的延迟和吞吐"""
+    count = min(count, 10000)
+    server = await asyncio.start_server(_echo, "127.0.0.1", 0)
+    target_port = server.sockets[0].getsockname()[1]
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        listen_port = s.getsockname()[1]
+    relay = RelayManager()
+    relay.add(listen_port, target_port)
+    for name, port in (("direct", target_port), ("relay", listen_port)):
+        latencies, throughput = await _measure_port(port, count, 256 * 1024 * 1024)
+        latencies.sort()
+        print("forward %-6s: p50 %7.1fus  p99 %7.1fus  %8.1f MB/s" % (
+            name, latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6, throughput))
+    relay.close()
+    server.close()
+    await server.wait_closed()
+
+
+async def bench_screencap(count: int, serial: str = None):
+    """单台设备每秒截图数 对比adb exec-out screencap与uiautomator2两种方式"""
+    import uiautomator2
+    from android import screencap
+    from android.adb import adb
+    from tools.imageutil import JSON_OPTIONS, encode_image
+
+    if not serial:
+        devices = await adb.device_list()
+        if not devices:
+            print("no android device")
+            return
+        serial = devices[0].serial
+    count = min(count, 30)
+    loop = asyncio.get_event_loop()
+    device = uiautomator2.Device(serial)
+
+    async def u2_frame():
+        image = await loop.run_in_executor(None, device.screenshot)
+        return await loop.run_in_executor(None, encode_image, image, JSON_OPTIONS)
+
+    async def screencap_frame():
+        data = await adb.exec_out(serial, "screencap")
+        return await loop.run_in_executor(screencap.encode_pool(), screencap.encode_screencap, data, JSON_OPTIONS)
+
+    for name, frame in (("uiautomator2", u2_frame), ("screencap", screencap_frame)):
+        await frame()  # 预热 进程池启动等
+        start = time.perf_counter()
+        for _ in range(count):
+            await frame()
+        cost = time.perf_counter() - start
+        print("%s %-12s: %6.2f fps  %6.1f ms/frame" % (serial, name, count / cost, cost / count * 1000))
+
+
+BENCHMARKS = {
+    "control": bench_control,
+    "forward": bench_forward,
+    "screencap": bench_screencap,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=sorted(BENCHMARKS), help="benchmark name")
+    parser.add_argument("-n", "--count", type=int, default=100000, help="iterations")
+    parser.add_argument("-s", "--serial", help="device serial, for device benchmarks")
+    args = parser.parse_args()
+    asyncio.run(BENCHMARKS[args.name](args.count, args.serial))
+
+
+if __name__ == '__main__':
+    main()
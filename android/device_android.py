@@ -1,28 +1,77 @@
 # coding: utf-8
 # copyright by codeskyblue of openATX
 
+import asyncio
+import json
 import subprocess
 import sys
 import traceback
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import uiautomator2
 from adbutils import adb as adbclient
 from logzero import logger
-import apkutils2 as apkutils
+from tornado import httpclient
+from tornado.concurrent import run_on_executor
+from tornado.ioloop import IOLoop
 from weditor.web import uidumplib
 
 from tools import download
+from android import screencap
 from android.adb import adb
+from android.forward_registry import forward_registry
+from android.proxy_port import relay
+from android.provision import provision_store, bundle_hash, file_md5
+from android.scrcpy.profile import covers
 from tools.config import config
 from tools.freeport import FreePort
+from tools.imageutil import ImageOptions, JSON_OPTIONS, encode_image
+from tools.screencache import ScreenshotCache
 
 
 class InitError(Exception):
     """ device init error """
 
 
+# 每台设备的属性快照 设备重新连接时失效
+PROPERTY_CACHE = dict()
+SCREEN_SIZE_KEY = "wm.size"
+ATX_AGENT_MARKER = "__LM_ATX_AGENT__"
+ATX_AGENT_PORT = 7912
+WHATSINPUT_PORT = 6677
+# 冷却时健康检查的超时时间
+HEALTHCHECK_TIMEOUT = 2
+ATX_AGENT_PATH = "/data/local/tmp/atx-agent"
+SCRCPY_SERVER_PATH = "/data/local/tmp/scrcpy-server"
+# 预置时需要推送的文件
+PROVISION_FILES = (ATX_AGENT_PATH, SCRCPY_SERVER_PATH)
+
+
+def parse_properties(output: str) -> dict:
+    """
+    解析 getprop; wm size 的输出
+    Example output:
+        [ro.product.brand]: [Xiaomi]
+        Physical size: 1080x2340
+    """
+    props = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("[") and "]: [" in line:
+            key, value = line[1:].split("]: [", 1)
+            props[key] = value[:-1] if value.endswith("]") else value
+        elif "size: " in line:
+            # 有Override size时以最后一行为准
+            props[SCREEN_SIZE_KEY] = line.split(": ")[-1]
+    return props
+
+
+def invalidate_properties(serial: str):
+    PROPERTY_CACHE.pop(serial, None)
+
+
 class AndroidDevice(object):
     def __init__(self, serial: str, free_port: FreePort):
         self._free_port = free_port
@@ -30,9 +79,15 @@ class AndroidDevice(object):
         self._procs = []
         self._current_ip = config.host
         self._scrcpy_server = None
-        self._agent_server = None
-        self._input_server = None
+        self._atx_proxy_port = None
+        self._whatsinput_port = None
         self._device = adbclient.device(serial)
+        # 推送文件、安装应用、截图等阻塞操作在设备独立的线程池执行 不阻塞IOLoop
+        self._executor = ThreadPoolExecutor(2, thread_name_prefix="android-" + serial)
+        # 本次预置记录的文件md5和应用版本
+        self._provision = None
+        self._atx_agent_running = False
+        self.screenshot_cache = ScreenshotCache(config.screenshot_cache_ttl)
 
     def __repr__(self):
         return "[" + self._serial + "]"
@@ -50,34 +105,116 @@ class AndroidDevice(object):
     async def init(self):
         """初始化设备"""
         logger.info("Init device: %s", self._serial)
-        self._version = await self.getprop("ro.build.version.release")
-        self._init_binaries()
-        self._init_apks()
-        await adb.shell(self._serial, "/data/local/tmp/atx-agent server --stop")
-        await adb.shell(self._serial, "cd /data/local/tmp && ./atx-agent server --nouia -d")
+        props = await self.load_properties()
+        self._version = props.get("ro.build.version.release", "")
+        if await self._check_provisioned():
+            logger.info("%s already provisioned", self)
+        else:
+            await self._init_binaries()
+            failed = await self._init_apks()
+            if failed:
+                # 有应用安装失败时不记录预置状态 下次接入重新预置
+                logger.warning("%s install apks failed: %s", self, failed)
+                provision_store.forget(self._serial)
+            else:
+                provision_store.set(self._serial, self._provision)
+            self._atx_agent_running = False
+        if not self._atx_agent_running:
+            await adb.shell(self._serial, "/data/local/tmp/atx-agent server --stop")
+            await adb.shell(self._serial, "cd /data/local/tmp && ./atx-agent server --nouia -d")
         await self._init_forwards()
         await self.start_server()
 
     async def open_identify(self):
         await adb.shell(self._serial, "am start -n com.github.uiautomator/.IdentifyActivity -e theme black")
 
-    async def start_server(self):
-        """启动scrcpy服务"""
+    async def start_server(self, port: int = None):
+        """启动scrcpy服务 port不为空时沿用原端口"""
         if self._scrcpy_server:
             self._scrcpy_server.terminate()
-        self._scrcpy_server_port = self._free_port.get()
+            await IOLoop.current().run_in_executor(self._executor, self._wait_process, self._scrcpy_server)
+        self._scrcpy_server_port = port or self._free_port.get()
         self._scrcpy_server = subprocess.Popen([
             sys.executable, "-u", "android/proxy_scrcpy.py",
             "-s", self._serial,
-            "-sp", str(self._scrcpy_server_port)],
+            "-sp", str(self._scrcpy_server_port)] + await self._scrcpy_options(),
             stdout=sys.stdout)
         logger.info("[%s] scrcpy server start, port %s" % (self._serial, self._scrcpy_server_port))
 
-    def _init_binaries(self):
+    @staticmethod
+    def _wait_process(proc, timeout=3):
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    async def _scrcpy_options(self) -> list:
+        """机型配置的scrcpy参数"""
+        model = await self.getprop("ro.product.model")
+        options = config.scrcpy_models.get(model, {})
+        args = []
+        for key in ("encoder-name", "codec-options", "max-size", "bit-rate", "max-fps"):
+            if options.get(key):
+                args += ["--" + key, options[key]]
+        if args:
+            logger.info("%s scrcpy options: %s", self, args)
+        return args
+
+    def _bundle_paths(self) -> list:
+        return [download.get_atx_agent_bundle(), download.get_scrcpy_server()] + self._apk_paths()
+
+    @staticmethod
+    def _apk_paths() -> list:
+        return [download.get_whatsinput_apk()] + list(download.get_uiautomator_apks())
+
+    def _expected_packages(self) -> set:
+        return set(provision_store.manifest(path)["package_name"] for path in self._apk_paths())
+
+    async def _check_provisioned(self) -> bool:
+        """
+        依赖包未更新且设备上已预置过时 只用一次shell校验文件md5、已安装应用和atx-agent进程
+        """
+        loop = IOLoop.current()
+        bundle = await loop.run_in_executor(self._executor, lambda: bundle_hash(self._bundle_paths()))
+        self._provision = {"bundle": bundle, "files": {}, "packages": {}}
+        self._atx_agent_running = False
+        record = provision_store.get(self._serial)
+        if not record or record.get("bundle") != bundle:
+            return False
+        # 记录需包含全部应该推送的文件和安装的应用
+        expected = await loop.run_in_executor(self._executor, self._expected_packages)
+        if set(record.get("files", {})) != set(PROVISION_FILES) or not expected <= set(record.get("packages", {})):
+            return False
+        output = await adb.shell(self._serial, "md5sum %s; pm list packages --show-versioncode 2>/dev/null "
+                                               "|| pm list packages; echo %s; pidof atx-agent"
+                                 % (" ".join(record["files"]), ATX_AGENT_MARKER))
+        listing, _, pid = output.partition(ATX_AGENT_MARKER)
+        md5s, packages = {}, {}
+        for line in listing.splitlines():
+            fields = line.split()
+            if line.startswith("package:"):
+                name = fields[0][len("package:"):]
+                version = fields[1].split(":", 1)[1] if len(fields) > 1 and ":" in fields[1] else None
+                packages[name] = version
+            elif len(fields) == 2:
+                md5s[fields[1]] = fields[0]
+        for dest, md5 in record["files"].items():
+            if md5s.get(dest) != md5:
+                logger.info("%s %s changed, provision again", self, dest)
+                return False
+        for name, version in record["packages"].items():
+            if name not in packages or (packages[name] and packages[name] != str(version)):
+                logger.info("%s %s changed, provision again", self, name)
+                return False
+        self._provision = record
+        self._atx_agent_running = bool(pid.strip())
+        return True
+
+    async def _init_binaries(self):
         """初始化依赖包"""
-        d = self._device
-        abi = d.getprop('ro.product.cpu.abi')
-        abis = (d.getprop('ro.product.cpu.abilist').strip() or abi).split(",")
+        props = PROPERTY_CACHE.get(self._serial) or {}
+        abi = props.get('ro.product.cpu.abi', '')
+        abis = (props.get('ro.product.cpu.abilist', '').strip() or abi).split(",")
         abimaps = {
             'armeabi-v7a': 'atx-agent-armv7',
             'arm64-v8a': 'atx-agent-armv7',
@@ -90,76 +227,90 @@ class AndroidDevice(object):
             raise InitError("no avaliable abilist", abis)
         logger.debug("%s use atx-agent: %s", self, okfiles[0])
         zipfile_path = download.get_atx_agent_bundle()
-        self._push_file(okfiles[0],"/data/local/tmp/atx-agent",zipfile_path=zipfile_path)
+        await self._push_file(okfiles[0], ATX_AGENT_PATH, zipfile_path=zipfile_path)
         # scrcpy
         scrcpy_zippath = download.get_scrcpy_server()
-        self._push_file("scrcpy-server", "/data/local/tmp/scrcpy-server", zipfile_path=scrcpy_zippath)
-
-    def _push_file(self, path: str, dest: str, zipfile_path: str, mode=0o755):
-        """上传文件到手机"""
-        with zipfile.ZipFile(zipfile_path) as z:
-            src_info = z.getinfo(path)
-            dest_info = self._device.sync.stat(dest)
-            if dest_info.size == src_info.file_size and dest_info.mode & mode == mode:
+        await self._push_file("scrcpy-server", SCRCPY_SERVER_PATH, zipfile_path=scrcpy_zippath)
+
+    async def _push_file(self, path: str, dest: str, zipfile_path: str, mode=0o755):
+        """上传文件到手机 直接从zip成员分块读取 按内容md5判断是否需要推送"""
+        local_md5 = await IOLoop.current().run_in_executor(self._executor, file_md5, zipfile_path, path)
+        self._provision["files"][dest] = local_md5
+        dest_info = await adb.stat(self._serial, dest)
+        if dest_info.mode & mode == mode:
+            remote = (await adb.shell(self._serial, "md5sum " + dest)).split()
+            if remote and remote[0] == local_md5:
                 logger.debug("%s already pushed %s", self, path)
                 return
+        with zipfile.ZipFile(zipfile_path) as z:
+            src_info = z.getinfo(path)
             with z.open(path) as f:
-                self._device.sync.push(f, dest, mode)
+                await adb.push(self._serial, f, dest, mode, total=src_info.file_size)
 
-    def _init_apks(self):
-        whatsinput_apk_path = download.get_whatsinput_apk()
-        self._install_apk(whatsinput_apk_path)
-        for apk_path in download.get_uiautomator_apks():
-            self._install_apk(apk_path)
+    @run_on_executor(executor='_executor')
+    def _init_apks(self) -> list:
+        """安装依赖应用 返回安装失败的apk"""
+        return [path for path in self._apk_paths() if not self._install_apk(path)]
 
-    def _install_apk(self, path: str):
+    def _install_apk(self, path: str) -> bool:
         assert path, "Invalid %s" % path
         try:
-            m = apkutils.APK(path).manifest
-            info = self._device.package_info(m.package_name)
-            if info and m.version_code == str(info['version_code']) and (
-                    m.version_name == info['version_name'] or info['version_name'] == 'null'):
+            m = provision_store.manifest(path)
+            info = self._device.package_info(m['package_name'])
+            if info and m['version_code'] == str(info['version_code']) and (
+                    m['version_name'] == info['version_name'] or info['version_name'] == 'null'):
                 logger.debug("%s already installed %s", self, path)
             else:
-                print(info, ":", m.version_code, m.version_name)
+                print(info, ":", m['version_code'], m['version_name'])
                 logger.debug("%s install %s", self, path)
                 self._device.install(path)
+            self._provision["packages"][m['package_name']] = m['version_code']
+            return True
         except Exception as e:
             traceback.print_exc()
             logger.warning("%s Install apk %s error %s", self, path, e)
+            return False
 
     async def _init_forwards(self):
         """代理手机端口"""
         logger.debug("%s forward atx-agent", self)
-        if self._agent_server:
-            self._agent_server.terminate()
-        self._atx_proxy_port, self._agent_server = await self.proxy_device_port(7912)
+        self._close_forwards()
+        self._atx_proxy_port = await self.proxy_device_port(ATX_AGENT_PORT)
         logger.debug("%s forward whatsinput", self)
-        if self._input_server:
-            self._input_server.terminate()
-        self._whatsinput_port, self._input_server = await self.proxy_device_port(6677)
+        self._whatsinput_port = await self.proxy_device_port(WHATSINPUT_PORT)
+
+    def _close_forwards(self):
+        for port in (self._atx_proxy_port, self._whatsinput_port):
+            if port:
+                relay.remove(port)
+        self._atx_proxy_port = None
+        self._whatsinput_port = None
 
     async def adb_forward_to_any(self, remote: str) -> int:
-        async for f in adb.forward_list():
-            if f.serial == self._serial:
-                if f.remote == remote and f.local.startswith("tcp:"):
-                    return int(f.local[4:])
-
-        local_port = self._free_port.get()
-        await adb.forward(self._serial, 'tcp:{}'.format(local_port), remote)
-        return local_port
-
-    async def proxy_device_port(self, device_port: int) -> tuple:
-        """ reverse-proxy device:port to *:port """
-        local_port = await self.adb_forward_to_any("tcp:" + str(device_port))
-        listen_port = self._free_port.get()
+        return await forward_registry.get_or_create(self._serial, remote, self._free_port.get)
+
+    async def proxy_device_port(self, device_port: int, listen_port: int = None) -> int:
+        """
+        reverse-proxy device:port to *:port listen_port不为空时沿用原端口
+        direct模式下adb server监听外部网卡 直接返回adb转发端口 不可达时回退到relay
+        """
+        remote = "tcp:" + str(device_port)
+        if config.android_forward_mode == "direct":
+            local_port = await forward_registry.get_or_create(
+                self._serial, remote, lambda: listen_port or self._free_port.get())
+            if await self._check_port(local_port, config.host):
+                logger.debug("%s direct port %s:%d -> %s", self, config.host, local_port, remote)
+                return local_port
+            logger.warning("%s adb forward port %d is not reachable on %s, fallback to relay",
+                           self, local_port, config.host)
+            if listen_port == local_port:
+                listen_port = None
+        else:
+            local_port = await self.adb_forward_to_any(remote)
+        listen_port = listen_port or self._free_port.get()
         logger.debug("%s proxy port start *:%d -> %d", self, local_port, listen_port)
-        server = subprocess.Popen([
-            sys.executable, "-u", "android/proxy_port.py",
-            "-lp", str(listen_port),
-            "-tp", str(local_port)],
-            stdout=sys.stdout)
-        return listen_port, server
+        relay.add(listen_port, local_port)
+        return listen_port
 
     @property
     def addrs(self):
@@ -182,46 +333,211 @@ class AndroidDevice(object):
         self._procs.append(p)
         return p
 
+    async def load_properties(self, refresh=False) -> dict:
+        """一次getprop获取全部属性 同一设备连接期间复用"""
+        if refresh or self._serial not in PROPERTY_CACHE:
+            output = await adb.shell(self._serial, "getprop; wm size")
+            PROPERTY_CACHE[self._serial] = parse_properties(output)
+        return PROPERTY_CACHE[self._serial]
+
     async def getprop(self, name: str) -> str:
-        value = await adb.shell(self._serial, "getprop " + name)
-        return value.strip()
+        props = await self.load_properties()
+        return props.get(name, "")
 
     async def getinfo(self, script:str):
         value = await adb.shell(self._serial, script)
         return value.strip()
 
     async def properties(self):
-        brand = await self.getprop("ro.product.brand")
-        model = await self.getprop("ro.product.model")
-        size = await self.getinfo("wm size")
+        props = await self.load_properties()
+        brand = props.get("ro.product.brand", "")
+        model = props.get("ro.product.model", "")
+        size = props.get(SCREEN_SIZE_KEY, "")
         return {
             "system": "android",
             "brand": brand,
             "version": self._version,
             "model": model,
             "name": model,
-            "size": size.split(": ")[-1],
+            "size": size,
+        }
+
+    async def scrcpy_input(self, data: dict) -> bool:
+        """通过scrcpy控制通道发送按键/文本 scrcpy会话未运行时返回False"""
+        if not self._scrcpy_server:
+            return False
+        try:
+            request = httpclient.HTTPRequest("http://127.0.0.1:%d/input" % self._scrcpy_server_port,
+                                             method="POST", body=json.dumps(data),
+                                             connect_timeout=1, request_timeout=3)
+            resp = await httpclient.AsyncHTTPClient().fetch(request)
+            return json.loads(resp.body)["status"] == 0
+        except Exception as e:
+            logger.debug("%s scrcpy input error: %s", self, e)
+            return False
+
+    async def press_key(self, keycode: int):
+        if await self.scrcpy_input({"msg_type": 0, "keycode": keycode}):
+            return
+        await adb.shell(self._serial, "input keyevent %d" % keycode)
+
+    async def reset(self, full=False):
+        """
+        冷却设备 默认只重启健康检查失败的组件 对外端口保持不变
+        full为True或设备未完成初始化时 与首次接入一样完整初始化
+        """
+        await self.press_key(3)  # KEYCODE_HOME
+        if full or not self._atx_proxy_port or not self._whatsinput_port or not self._scrcpy_server:
+            self._stop()
+            await self.init()
+            return
+        health = await self.healthcheck()
+        logger.info("%s healthcheck: %s", self, health)
+        if not health["forwards"]:
+            self._atx_proxy_port = await self.proxy_device_port(ATX_AGENT_PORT, self._atx_proxy_port)
+            self._whatsinput_port = await self.proxy_device_port(WHATSINPUT_PORT, self._whatsinput_port)
+        if not health["atx-agent"]:
+            await adb.shell(self._serial, "/data/local/tmp/atx-agent server --stop")
+            await adb.shell(self._serial, "cd /data/local/tmp && ./atx-agent server --nouia -d")
+        if not health["whatsinput"]:
+            await IOLoop.current().run_in_executor(self._executor, self._install_apk, download.get_whatsinput_apk())
+        if not health["scrcpy"]:
+            await self.start_server(self._scrcpy_server_port)
+
+    async def healthcheck(self) -> dict:
+        """检查端口转发、atx-agent、WhatsInput和scrcpy代理 返回各组件是否正常"""
+        whatsinput = await IOLoop.current().run_in_executor(
+            self._executor, lambda: provision_store.manifest(download.get_whatsinput_apk())["package_name"])
+        output = await adb.shell(self._serial, "pidof atx-agent; echo %s; pm path %s"
+                                 % (ATX_AGENT_MARKER, whatsinput))
+        pid, _, package = output.partition(ATX_AGENT_MARKER)
+        # 冷却时以adb实际的转发为准
+        await forward_registry.sync(gc=False)
+        forwards_ok = True
+        for device_port, listen_port in ((ATX_AGENT_PORT, self._atx_proxy_port),
+                                         (WHATSINPUT_PORT, self._whatsinput_port)):
+            local_port = forward_registry.lookup(self._serial, "tcp:%d" % device_port)
+            listener = relay.get(listen_port)
+            # direct模式对外端口就是adb转发端口
+            target_port = listener.target_port if listener else listen_port
+            if not local_port or target_port != local_port:
+                forwards_ok = False
+        atx_agent_ok = bool(pid.strip())
+        if atx_agent_ok and forwards_ok:
+            atx_agent_ok = await self._check_http("http://127.0.0.1:%d/version" % self._atx_proxy_port)
+        scrcpy_ok = self._scrcpy_server.poll() is None and await self._check_port(self._scrcpy_server_port)
+        return {
+            "forwards": forwards_ok,
+            "atx-agent": atx_agent_ok,
+            "whatsinput": package.strip().startswith("package:"),
+            "scrcpy": scrcpy_ok,
         }
 
-    async def reset(self):
-        self.close()
-        await adb.shell(self._serial, "input keyevent HOME")
-        await self.init()
+    @staticmethod
+    async def _check_http(url: str) -> bool:
+        try:
+            request = httpclient.HTTPRequest(url, connect_timeout=HEALTHCHECK_TIMEOUT,
+                                             request_timeout=HEALTHCHECK_TIMEOUT)
+            await httpclient.AsyncHTTPClient().fetch(request)
+            return True
+        except Exception as e:
+            logger.debug("healthcheck %s error: %s", url, e)
+            return False
+
+    @staticmethod
+    async def _check_port(port: int, host="127.0.0.1") -> bool:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HEALTHCHECK_TIMEOUT)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
 
     def wait(self):
         for p in self._procs:
             p.wait()
 
-    def close(self):
+    def _stop(self):
         for p in self._procs:
             p.terminate()
         self._procs = []
+        if self._scrcpy_server:
+            # 在线程池中等待退出 超时则强制结束 释放scrcpy代理端口
+            self._scrcpy_server.terminate()
+            self._executor.submit(self._wait_process, self._scrcpy_server)
+            self._scrcpy_server = None
+        self._close_forwards()
 
+    def close(self):
+        """设备下线 停止进程和端口转发并释放线程池"""
+        self._stop()
+        self._executor.shutdown(wait=False)
+
+    async def get_screenshot_jpeg(self) -> bytes:
+        return await self.get_screenshot_encoded(JSON_OPTIONS)
+
+    async def get_screenshot_encoded(self, options: ImageOptions) -> bytes:
+        """按指定格式、质量、尺寸编码截图 并发请求共享同一次截图"""
+        return await self.screenshot_cache.get(options, lambda: self._capture(options.max_side),
+                                               lambda frame: self._encode_frame(frame, options),
+                                               lambda frame: self._covers(frame, options.max_side))
+
+    @staticmethod
+    def _covers(frame, max_side: int = None) -> bool:
+        """截图分辨率是否满足请求 缩略图档位的投屏画面只用于长边不超过画面的请求"""
+        if not isinstance(frame, bytes):
+            return True
+        width, height = screencap.parse_header(frame)[:2]
+        return covers(max(width, height), max_side)
+
+    async def _capture(self, max_side: int = None):
+        """
+        投屏进行中、画面足够新且分辨率满足请求时直接使用scrcpy的最新画面 与观众看到的一致
+        否则通过adb exec-out读取screencap原始像素 失败时回退到uiautomator2截图
+        """
+        data = await self._stream_frame(max_side)
+        if data:
+            return data
+        try:
+            data = await adb.exec_out(self._serial, "screencap")
+            screencap.parse_header(data)
+            return data
+        except Exception as e:
+            logger.debug("%s screencap error: %s, fallback to uiautomator2", self, e)
+            return await self.get_screenshot()
+
+    async def _stream_frame(self, max_side: int = None) -> bytes:
+        if not self._scrcpy_server or self._scrcpy_server.poll() is not None:
+            return None
+        try:
+            request = httpclient.HTTPRequest("http://127.0.0.1:%d/frame?max_age=%s&max_side=%d"
+                                             % (self._scrcpy_server_port, config.scrcpy_frame_max_age,
+                                                max_side or 0),
+                                             connect_timeout=1, request_timeout=3)
+            resp = await httpclient.AsyncHTTPClient().fetch(request)
+            if resp.headers.get("Content-Type") == "application/octet-stream":
+                screencap.parse_header(resp.body)
+                return resp.body
+        except Exception as e:
+            logger.debug("%s scrcpy frame error: %s", self, e)
+        return None
+
+    async def _encode_frame(self, frame, options: ImageOptions) -> bytes:
+        loop = IOLoop.current()
+        if isinstance(frame, bytes):
+            return await loop.run_in_executor(screencap.encode_pool(), screencap.encode_screencap, frame, options)
+        return await loop.run_in_executor(self._executor, encode_image, frame, options)
+
+    @run_on_executor(executor='_executor')
     def get_screenshot(self):
+        return self._get_screenshot()
+
+    def _get_screenshot(self):
         device = uiautomator2.Device(self._serial)
         screenshot = device.screenshot()
         return screenshot
 
+    @run_on_executor(executor='_executor')
     def dump_hierarchy(self):
         device = uiautomator2.Device(self._serial)
         current = device.app_current()
@@ -0,0 +1,94 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import asyncio
+
+from logzero import logger
+
+from android.adb import adb
+
+
+class ForwardRegistry(object):
+    """
+    全局adb端口转发表 首次使用时与adb同步一次 按(serial, remote)索引
+    新建转发和设备下线时增量更新 同步时清理已不在线设备的转发
+    """
+
+    def __init__(self, client=adb):
+        self._client = client
+        # (serial, remote) -> 本机端口
+        self._index = dict()
+        self._synced = False
+        self._lock = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, serial: str, remote: str) -> int:
+        return self._index.get((serial, remote))
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _load(self):
+        index = dict()
+        async for f in self._client.forward_list():
+            if f.local.startswith("tcp:"):
+                index[(f.serial, f.remote)] = int(f.local[4:])
+        self._index = index
+        self._synced = True
+        logger.debug("forward registry synced, %d forwards", len(index))
+
+    async def sync(self, gc=True):
+        """从adb重新加载转发表 gc为True时移除不在线设备的转发"""
+        async with self._get_lock():
+            await self._load()
+        if gc:
+            await self.gc()
+
+    async def gc(self):
+        online = set(d.serial for d in await self._client.device_list())
+        for serial in set(serial for serial, _ in list(self._index)) - online:
+            await self.remove_device(serial)
+
+    async def get_or_create(self, serial: str, remote: str, port_factory) -> int:
+        """返回已有转发的本机端口 没有则用port_factory分配端口新建转发"""
+        gc = False
+        async with self._get_lock():
+            if not self._synced:
+                await self._load()
+                gc = True
+            local_port = self.lookup(serial, remote)
+            if not local_port:
+                local_port = port_factory()
+                await self._client.forward(serial, "tcp:%d" % local_port, remote)
+                self._index[(serial, remote)] = local_port
+        if gc:
+            await self.gc()
+        return local_port
+
+    async def remove(self, serial: str, remote: str):
+        local_port = self._index.pop((serial, remote), None)
+        if local_port:
+            await self._kill(serial, local_port)
+
+    async def remove_device(self, serial: str):
+        """设备下线时移除该设备的全部转发"""
+        for key in [key for key in self._index if key[0] == serial]:
+            # gc和设备下线可能同时移除同一设备的转发
+            local_port = self._index.pop(key, None)
+            if local_port:
+                await self._kill(serial, local_port)
+
+    async def _kill(self, serial: str, local_port: int):
+        try:
+            await self._client.forward_remove(serial, "tcp:%d" % local_port)
+            logger.debug("remove forward %s tcp:%d", serial, local_port)
+        except Exception as e:
+            # 设备已断开时adb会自动清理转发
+            logger.debug("remove forward %s tcp:%d error: %s", serial, local_port, e)
+
+
+forward_registry = ForwardRegistry()
@@ -0,0 +1,117 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import hashlib
+import json
+import os
+import threading
+import zipfile
+
+import apkutils2 as apkutils
+from logzero import logger
+
+
+STORE_PATH = "tmp/android/provision.json"
+
+# (路径, 成员) -> ((大小, 修改时间), md5) 文件未变化时不重复计算
+_md5_cache = dict()
+_lock = threading.Lock()
+
+
+def file_md5(path: str, member: str = None) -> str:
+    """计算文件或zip成员的md5 按文件大小和修改时间缓存"""
+    st = os.stat(path)
+    key = (path, member)
+    version = (st.st_size, st.st_mtime)
+    with _lock:
+        cached = _md5_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    m = hashlib.md5()
+    if member:
+        with zipfile.ZipFile(path) as z, z.open(member) as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                m.update(chunk)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                m.update(chunk)
+    with _lock:
+        _md5_cache[key] = (version, m.hexdigest())
+    return m.hexdigest()
+
+
+def bundle_hash(paths: list) -> str:
+    """依赖包整体的hash 任一依赖包更新后设备需要重新预置"""
+    m = hashlib.md5()
+    for path in sorted(paths):
+        m.update(file_md5(path).encode("utf-8"))
+    return m.hexdigest()
+
+
+class ProvisionStore(object):
+    """
+    设备预置状态 按serial记录依赖包hash、已推送文件的md5和已安装应用的版本
+    同时缓存apk的manifest解析结果 保存在本地json文件
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self._path = path
+        self._data = {"devices": {}, "manifests": {}}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._data["devices"].update(data.get("devices", {}))
+            self._data["manifests"].update(data.get("manifests", {}))
+        except (ValueError, OSError) as e:
+            logger.warning("load provision store error: %s", e)
+
+    def save(self):
+        with self._lock:
+            content = json.dumps(self._data, ensure_ascii=False, indent=2)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, self._path)
+
+    def get(self, serial: str) -> dict:
+        with self._lock:
+            return self._data["devices"].get(serial)
+
+    def set(self, serial: str, record: dict):
+        with self._lock:
+            self._data["devices"][serial] = record
+        self.save()
+
+    def forget(self, serial: str):
+        with self._lock:
+            removed = self._data["devices"].pop(serial, None)
+        if removed:
+            self.save()
+
+    def manifest(self, path: str) -> dict:
+        """apk的包名和版本 按apk内容md5缓存"""
+        key = file_md5(path)
+        with self._lock:
+            cached = self._data["manifests"].get(key)
+        if cached:
+            return cached
+        m = apkutils.APK(path).manifest
+        info = {
+            "package_name": m.package_name,
+            "version_code": m.version_code,
+            "version_name": m.version_name,
+        }
+        with self._lock:
+            self._data["manifests"][key] = info
+        return info
+
+
+provision_store = ProvisionStore()
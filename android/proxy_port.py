@@ -1,43 +1,148 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
 import argparse
-import socket, threading
+import asyncio
+import socket
+
+from logzero import logger
+
 
+BUFFER_SIZE = 64 * 1024
 
-class PipeThread(threading.Thread):
 
-    def __init__(self, source_socket, target_socket):
-        threading.Thread.__init__(self)
-        self.source = source_socket
-        self.target = target_socket
+class RelayListener(object):
+    """监听本机端口 将每个连接双向转发到目标端口"""
+
+    def __init__(self, listen_port: int, target_port: int, target_host="127.0.0.1", bufsize=BUFFER_SIZE):
+        self.listen_port = listen_port
+        self.target_port = target_port
+        self.target_host = target_host
+        self._bufsize = bufsize
+        self._sock = None
+        self._accept_task = None
+        self._conn_tasks = set()
+
+    def __repr__(self):
+        return "<Relay *:%d -> %s:%d>" % (self.listen_port, self.target_host, self.target_port)
 
-    def run(self):
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("0.0.0.0", self.listen_port))
+        sock.listen(128)
+        sock.setblocking(False)
+        self._sock = sock
+        self._accept_task = asyncio.ensure_future(self._accept_forever())
+
+    def close(self):
+        if self._accept_task:
+            self._accept_task.cancel()
+            self._accept_task = None
+        for task in list(self._conn_tasks):
+            task.cancel()
+        self._conn_tasks.clear()
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    @property
+    def connections(self) -> int:
+        return len(self._conn_tasks)
+
+    async def _accept_forever(self):
+        loop = asyncio.get_event_loop()
         while True:
             try:
-                data = self.source.recv(1024)
-                if not data:
-                    break
-                self.target.send(data)
-            except:
+                client, _ = await loop.sock_accept(self._sock)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                logger.warning("%s accept error: %s", self, e)
+                await asyncio.sleep(0.1)
+                continue
+            task = asyncio.ensure_future(self._handle(client))
+            self._conn_tasks.add(task)
+            task.add_done_callback(self._conn_tasks.discard)
+
+    async def _handle(self, client: socket.socket):
+        loop = asyncio.get_event_loop()
+        client.setblocking(False)
+        target = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target.setblocking(False)
+        try:
+            await loop.sock_connect(target, (self.target_host, self.target_port))
+        except OSError as e:
+            logger.debug("%s connect target error: %s", self, e)
+            client.close()
+            target.close()
+            return
+        for s in (client, target):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pipes = [asyncio.ensure_future(self._pipe(client, target)),
+                 asyncio.ensure_future(self._pipe(target, client))]
+        try:
+            await asyncio.gather(*pipes)
+        except OSError as e:
+            logger.debug("%s connection broken: %s", self, e)
+        finally:
+            for p in pipes:
+                p.cancel()
+            client.close()
+            target.close()
+
+    async def _pipe(self, source: socket.socket, target: socket.socket):
+        """单向转发 读到EOF时半关闭目标端 另一方向继续转发直到对端也关闭"""
+        loop = asyncio.get_event_loop()
+        buffer = bytearray(self._bufsize)
+        view = memoryview(buffer)
+        while True:
+            size = await loop.sock_recv_into(source, buffer)
+            if not size:
                 break
+            await loop.sock_sendall(target, view[:size])
+        try:
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
 
 
-class Forwarding(threading.Thread):
+class RelayManager(object):
+    """进程内端口转发管理 设备上下线时增删监听"""
 
-    def __init__(self, local_port, target_port):
-        threading.Thread.__init__(self)
-        self.local_port = local_port
-        self.target_port = target_port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind(("0.0.0.0", local_port))
-        self.sock.listen(10)
+    def __init__(self, bufsize=BUFFER_SIZE):
+        self._bufsize = bufsize
+        self._listeners = dict()
 
-    def run(self):
-        while True:
-            client_fd, _ = self.sock.accept()
-            target_fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_fd.connect(("127.0.0.1", self.target_port))
-            # two direct pipe
-            PipeThread(target_fd, client_fd).start()
-            PipeThread(client_fd, target_fd).start()
+    def add(self, listen_port: int, target_port: int, target_host="127.0.0.1") -> RelayListener:
+        self.remove(listen_port)
+        listener = RelayListener(listen_port, target_port, target_host, self._bufsize)
+        listener.start()
+        self._listeners[listen_port] = listener
+        logger.debug("relay start %s", listener)
+        return listener
+
+    def remove(self, listen_port: int):
+        listener = self._listeners.pop(listen_port, None)
+        if listener:
+            listener.close()
+            logger.debug("relay stop %s", listener)
+
+    def get(self, listen_port: int) -> RelayListener:
+        return self._listeners.get(listen_port)
+
+    def close(self):
+        for port in list(self._listeners):
+            self.remove(port)
+
+    def __contains__(self, listen_port: int):
+        return listen_port in self._listeners
+
+    def __len__(self):
+        return len(self._listeners)
+
+
+relay = RelayManager()
 
 
 if __name__ == '__main__':
@@ -50,7 +155,6 @@ if __name__ == '__main__':
                         type=int,
                         help="target port")
     args = parser.parse_args()
-    local_port = int(args.local_port)
-    target_port = int(args.target_port)
-    Forwarding(local_port, target_port).start()
-
+    loop = asyncio.get_event_loop()
+    relay.add(int(args.local_port), int(args.target_port))
+    loop.run_forever()
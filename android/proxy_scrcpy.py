@@ -6,16 +6,60 @@ import tornado
 import tornado.web
 import tornado.netutil
 import tornado.process
+from logzero import logger
 
 from scrcpy.client import ClientDevice
+from scrcpy.profile import DEFAULT_PROFILE, covers
 
 DEVICE_ID = None
-H264_HEADER = []
+# scrcpy服务启动参数 未指定的使用ClientDevice默认值
+CLIENT_OPTIONS = dict()
 SOCKET_PORT = None
 SOCKET_SERVER = None
 SOCKET_CLIENT = None
 
 
+async def dispatch_control(controller, data: dict):
+    """按msg_type执行json控制消息"""
+    # keycode
+    if data['msg_type'] == 0:
+        await controller.inject_keycode(keycode=data['keycode'], action=data.get('action'),
+                                        metastate=data.get('metastate', 0))
+    # text
+    elif data['msg_type'] == 1:
+        await controller.inject_text(data['text'])
+    # set clipboard
+    elif data['msg_type'] == 9:
+        await controller.set_clipboard(data['text'], paste=data.get('paste', False))
+    # touch
+    elif data['msg_type'] == 2:
+        await controller.inject_touch_event(x=data['x'], y=data['y'], action=data['action'])
+    # scroll
+    elif data['msg_type'] == 3:
+        await controller.inject_scroll_event(x=data['x'], y=data['y'],
+                                             distance_x=data['distance_x'], distance_y=data['distance_y'])
+    # swipe
+    elif data['msg_type'] == 30:
+        await controller.swipe(x=data['x'], y=data['y'], end_x=data['end_x'], end_y=data['end_y'],
+                               unit=data.get('unit', 5), delay=data['delay'],
+                               easing=data.get('easing', 'linear'))
+    # multi-segment swipe
+    elif data['msg_type'] == 31:
+        await controller.swipe_path(points=data['points'], duration=data['delay'],
+                                    easing=data.get('easing', 'linear'))
+    # pinch
+    elif data['msg_type'] == 32:
+        await controller.pinch(x=data['x'], y=data['y'], start_distance=data['start_distance'],
+                               end_distance=data['end_distance'], delay=data['delay'],
+                               angle=data.get('angle', 0), easing=data.get('easing', 'linear'))
+    # rotate
+    elif data['msg_type'] == 33:
+        await controller.rotate(x=data['x'], y=data['y'], radius=data['radius'],
+                                start_angle=data['start_angle'], end_angle=data['end_angle'],
+                                delay=data['delay'], fingers=data.get('fingers', 2),
+                                easing=data.get('easing', 'linear'))
+
+
 class ScrcpyWSHandler(websocket.WebSocketHandler):
     """scrcpy投屏"""
     DEVICE_CLIENT_DICT = dict()
@@ -33,38 +77,105 @@ class ScrcpyWSHandler(websocket.WebSocketHandler):
         if old_device_client:
             self.device_client = old_device_client
         else:
-            self.device_client = self.DEVICE_CLIENT_DICT[self.device_id] = ClientDevice(self.device_id)
+            self.device_client = self.DEVICE_CLIENT_DICT[self.device_id] = ClientDevice(self.device_id, **CLIENT_OPTIONS)
         if "screen" in self.request.path:
-            self.device_client.ws_client_list.append(self)
-            # 重新启动scrcpy 重新开始任务
+            try:
+                self.device_client.set_viewer_profile(self, self.get_argument("profile", DEFAULT_PROFILE))
+            except ValueError as e:
+                self.close(reason=str(e))
+                return
             async with self.device_client.device_lock:
-                await self.device_client.stop()
-                await self.device_client.start()
+                target = self.device_client.target_profile()
+                if self.device_client.alive and target == self.device_client.profile:
+                    # 加入正在运行的会话 先推送缓存的SPS/PPS/IDR
+                    self.device_client.join(self)
+                else:
+                    # scrcpy未启动、已退出或需要更高画质 重新启动
+                    self.device_client.broadcaster.add(self)
+                    self.device_client.apply_profile(target)
+                    await self.device_client.stop()
+                    await self.device_client.start()
         else:
             self.device_client.ws_touch_list.append(self)
 
     async def on_message(self, text_data):
         """receive used to control device"""
+        # 二进制消息 按scrcpy控制消息布局直接转发 只有/touch允许控制
+        if isinstance(text_data, bytes):
+            if "screen" in self.request.path:
+                return
+            try:
+                await self.device_client.controller.inject_binary(text_data)
+            except ValueError as e:
+                logger.debug("[%s] invalid control message: %s" % (self.device_id, e))
+            return
         data = json.loads(text_data)
-        # touch
-        if data['msg_type'] == 2:
-            await self.device_client.controller.inject_touch_event(x=data['x'], y=data['y'], action=data['action'])
-        # scroll
-        elif data['msg_type'] == 3:
-            await self.device_client.controller.inject_scroll_event(x=data['x'], y=data['y'],
-                                                                    distance_x=data['distance_x'], distance_y=data['distance_y'])
-        # swipe
-        elif data['msg_type'] == 30:
-            await self.device_client.controller.swipe(x=data['x'], y=data['y'], end_x=data['end_x'], end_y=data['end_y'],
-                                                      unit=data['unit'], delay=data['delay'])
+        # 切换画质档位 {"profile": "thumbnail"}
+        if "screen" in self.request.path:
+            if "profile" in data:
+                try:
+                    self.device_client.set_viewer_profile(self, data["profile"])
+                except ValueError as e:
+                    await self.write_message({"error": str(e)})
+                    return
+                await self.device_client.update_profile()
+            return
+        await dispatch_control(self.device_client.controller, data)
 
     def on_connection_close(self):
-        if self in self.device_client.ws_client_list:
-            self.device_client.ws_client_list.remove(self)
+        if self in self.device_client.viewer_profiles:
+            self.device_client.remove_viewer(self)
+            # 最高档位的观众离开后降低画质
+            ioloop.IOLoop.current().spawn_callback(self.device_client.update_profile)
         if self in self.device_client.ws_touch_list:
             self.device_client.ws_touch_list.remove(self)
 
 
+class InputHandler(tornado.web.RequestHandler):
+    """通过scrcpy控制通道发送按键、文本、剪贴板 body与/touch的json消息一致"""
+
+    async def post(self):
+        device_client = ScrcpyWSHandler.DEVICE_CLIENT_DICT.get(DEVICE_ID)
+        if not device_client or not device_client.control_socket:
+            self.write({"status": 1000, "message": "scrcpy未运行"})
+            return
+        try:
+            await dispatch_control(device_client.controller, json.loads(self.request.body.decode()))
+            await device_client.controller.flush()
+            self.write({"status": 0, "message": "发送成功"})
+        except Exception as e:
+            self.write({"status": 1000, "message": "发送失败: %s" % str(e)})
+
+
+class FrameHandler(tornado.web.RequestHandler):
+    """当前投屏的最新画面 返回screencap格式的RGB原始数据 供截图接口复用 max_side为请求需要的长边像素"""
+
+    async def get(self):
+        device_client = ScrcpyWSHandler.DEVICE_CLIENT_DICT.get(DEVICE_ID)
+        max_age = float(self.get_argument("max_age", "0.5"))
+        max_side = int(self.get_argument("max_side", "0"))
+        data = None
+        try:
+            # 缩略图档位的画面分辨率不足时由主进程改用screencap
+            if device_client and device_client.alive and covers(device_client.max_size, max_side):
+                data = await device_client.snapshot(max_age)
+        except Exception as e:
+            logger.warning("decode snapshot error: %s", e)
+        if not data:
+            self.write({"status": 1000, "message": "没有可用画面"})
+            return
+        self.set_header("Content-Type", "application/octet-stream")
+        self.write(data)
+
+
+async def discover_encoder():
+    """启动时探测设备编码器 首个观众连接时无需等待"""
+    device_client = ScrcpyWSHandler.DEVICE_CLIENT_DICT.setdefault(DEVICE_ID, ClientDevice(DEVICE_ID, **CLIENT_OPTIONS))
+    async with device_client.device_lock:
+        if not device_client.encoder_name:
+            await device_client.select_encoder()
+
+
 def start_server():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s",
@@ -74,17 +185,36 @@ def start_server():
                         "--server-port",
                         type=int,
                         help="scrcpy server port")
+    parser.add_argument("--encoder-name",
+                        help="video encoder name, auto select hardware encoder by default")
+    parser.add_argument("--codec-options",
+                        help="video codec options")
+    parser.add_argument("--max-size",
+                        type=int,
+                        help="max screen width")
+    parser.add_argument("--bit-rate",
+                        type=int,
+                        help="video bit rate")
+    parser.add_argument("--max-fps",
+                        type=int,
+                        help="max frame per second")
     args = parser.parse_args()
     global DEVICE_ID
     DEVICE_ID = args.serial
+    for key in ("encoder_name", "codec_options", "max_size", "bit_rate", "max_fps"):
+        if getattr(args, key) is not None:
+            CLIENT_OPTIONS[key] = getattr(args, key)
 
     app = tornado.web.Application([
         (r"/screen", ScrcpyWSHandler),
         (r"/touch", ScrcpyWSHandler),
+        (r"/input", InputHandler),
+        (r"/frame", FrameHandler),
     ], debug=False)
 
     http_server = httpserver.HTTPServer(app)
     http_server.listen(args.server_port)
+    ioloop.IOLoop.current().spawn_callback(discover_encoder)
     ioloop.IOLoop.instance().start()
 
 
@@ -0,0 +1,129 @@
+START_CODE = b'\x00\x00\x00\x01'
+
+NAL_TYPE_SLICE = 1
+NAL_TYPE_IDR = 5
+NAL_TYPE_SEI = 6
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+NAL_TYPE_AUD = 9
+
+VCL_TYPES = (NAL_TYPE_SLICE, NAL_TYPE_IDR)
+
+
+def nal_type(nal_data: bytes) -> int:
+    """返回带起始码的NAL单元类型"""
+    offset = 4 if nal_data.startswith(START_CODE) else 3
+    if len(nal_data) <= offset:
+        return -1
+    return nal_data[offset] & 0x1F
+
+
+class AnnexBParser:
+    """
+    增量解析H.264 Annex-B字节流 支持3字节和4字节起始码
+    输出的NAL单元统一使用4字节起始码 未完整的NAL保留在缓冲区等待后续数据
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan = 0      # 下次查找起始码的位置 避免重复扫描
+        self._nal_start = -1    # 当前NAL负载的起始位置
+
+    def feed(self, data: bytes) -> list:
+        buf = self._buffer
+        buf += data
+        nals = []
+        while True:
+            pos = buf.find(b'\x00\x00\x01', self._scan)
+            if pos < 0:
+                # 末尾两个字节可能是下一个起始码的前缀
+                self._scan = max(len(buf) - 2, self._nal_start, 0)
+                break
+            end = pos
+            # 4字节起始码及trailing_zero_8bits不属于当前NAL
+            while end > 0 and buf[end - 1] == 0 and end > self._nal_start:
+                end -= 1
+            if self._nal_start >= 0 and end > self._nal_start:
+                nals.append(START_CODE + bytes(buf[self._nal_start:end]))
+            self._nal_start = pos + 3
+            self._scan = pos + 3
+        # 丢弃已经输出的数据 保持缓冲区大小只和一个NAL相关
+        consumed = self._nal_start if self._nal_start >= 0 else self._scan
+        if consumed > 0:
+            del buf[:consumed]
+            self._scan -= consumed
+            if self._nal_start >= 0:
+                self._nal_start = 0
+        return nals
+
+    def flush(self) -> list:
+        """数据包结束时输出缓冲区中最后一个NAL 不必等待下一个起始码"""
+        nals = []
+        if self._nal_start >= 0 and len(self._buffer) > self._nal_start:
+            nals.append(START_CODE + bytes(self._buffer[self._nal_start:]))
+        self.reset()
+        return nals
+
+    def reset(self):
+        # 原地清空 复用已分配的缓冲区
+        del self._buffer[:]
+        self._scan = 0
+        self._nal_start = -1
+
+
+class AccessUnit(object):
+    """一帧完整的编码数据(访问单元) 可能包含SPS/PPS/SEI和多个slice"""
+
+    def __init__(self, nals: list):
+        self.nals = nals
+        self.nal_types = tuple(nal_type(nal) for nal in nals)
+        self.data = b''.join(nals)
+
+    @property
+    def keyframe(self) -> bool:
+        return NAL_TYPE_IDR in self.nal_types or NAL_TYPE_SPS in self.nal_types
+
+    def __len__(self):
+        return len(self.data)
+
+
+class AccessUnitAssembler:
+    """
+    将NAL单元组合为访问单元 遇到下一帧的第一个NAL时输出上一帧
+    已知帧边界(scrcpy frame meta)时调用flush立即输出 不增加一帧的延迟
+    """
+
+    def __init__(self):
+        self._nals = []
+        self._has_vcl = False
+
+    def push(self, nal: bytes):
+        """返回已完整的AccessUnit 没有则返回None"""
+        t = nal_type(nal)
+        unit = None
+        if self._has_vcl:
+            if t in VCL_TYPES:
+                # first_mb_in_slice为0(ue(v)首位为1)表示新的一帧
+                new_picture = len(nal) > 5 and nal[5] & 0x80
+            else:
+                new_picture = t in (NAL_TYPE_AUD, NAL_TYPE_SEI, NAL_TYPE_SPS, NAL_TYPE_PPS)
+            if new_picture:
+                unit = AccessUnit(self._nals)
+                self._nals = []
+                self._has_vcl = False
+        self._nals.append(nal)
+        if t in VCL_TYPES:
+            self._has_vcl = True
+        return unit
+
+    def flush(self):
+        """帧结束时输出当前访问单元 还没有slice(如单独的SPS/PPS)时继续等待"""
+        if not self._has_vcl:
+            return None
+        unit = AccessUnit(self._nals)
+        self.reset()
+        return unit
+
+    def reset(self):
+        self._nals = []
+        self._has_vcl = False
@@ -0,0 +1,192 @@
+import asyncio
+import collections
+import time
+from logzero import logger
+from tornado.websocket import WebSocketClosedError
+from scrcpy.annexb import AccessUnit, NAL_TYPE_IDR, NAL_TYPE_PPS, NAL_TYPE_SPS
+
+
+class Viewer:
+    """单个观众的发送队列 超出字节预算时丢弃积压数据直到下一个关键帧"""
+
+    def __init__(self, ws_client, max_bytes):
+        self.ws_client = ws_client
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._bytes = 0
+        # 加入时发送的缓存GOP 不计入字节预算 优先于实时数据发送
+        self._burst = collections.deque()
+        self._skipping = False
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._write_forever())
+
+    @property
+    def pending_bytes(self):
+        return self._bytes
+
+    def skip_to_keyframe(self):
+        self._skipping = True
+
+    def put_burst(self, frames: list):
+        """缓存的GOP整体入队 不受预算影响 避免从中间丢弃导致IDR丢失"""
+        self._burst.extend(frames)
+        self._event.set()
+
+    def put(self, data: bytes, keyframe: bool):
+        if self._skipping:
+            if not keyframe:
+                self.dropped += 1
+                return
+            self._skipping = False
+        if self._bytes + len(data) > self.max_bytes:
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            self._bytes = 0
+            if not keyframe:
+                self.dropped += 1
+                self._skipping = True
+                logger.debug("viewer %s too slow, skip to next keyframe", id(self.ws_client))
+                return
+        self._queue.append(data)
+        self._bytes += len(data)
+        self._event.set()
+
+    async def _write_forever(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            while self._burst or self._queue:
+                if self._burst:
+                    data = self._burst.popleft()
+                else:
+                    data = self._queue.popleft()
+                    self._bytes -= len(data)
+                try:
+                    await self.ws_client.write_message(data, True)
+                except WebSocketClosedError:
+                    return
+                except Exception as e:
+                    logger.info("viewer write error: %s", e)
+                    return
+
+    def close(self):
+        self._task.cancel()
+        self._queue.clear()
+        self._burst.clear()
+        self._bytes = 0
+
+
+# scrcpy服务端默认每10秒一个关键帧(i-frame-interval)
+KEYFRAME_INTERVAL = 10
+
+
+def gop_budget(bit_rate: int) -> int:
+    """按码率估算一个GOP的字节数 画面剧烈变化时编码器会短暂超出码率 预留一倍余量"""
+    return max(2 << 20, bit_rate // 8 * KEYFRAME_INTERVAL * 2)
+
+
+class KeyframeCache:
+    """缓存最近的SPS、PPS以及最近IDR开始的访问单元 新观众加入时先发送即可立即解码"""
+
+    def __init__(self, max_bytes=2 << 20):
+        self.max_bytes = max_bytes
+        self.sps = None
+        self.pps = None
+        self._gop = []
+        self._bytes = 0
+        # 每个新GOP加1 解码器据此判断能否接着上次解码
+        self.generation = 0
+        # 最近一帧的接收时间
+        self.updated = None
+        # GOP超出预算后缓存中没有最新帧
+        self.truncated = False
+
+    def update(self, unit: AccessUnit):
+        for nal, t in zip(unit.nals, unit.nal_types):
+            if t == NAL_TYPE_SPS:
+                self.sps = nal
+            elif t == NAL_TYPE_PPS:
+                self.pps = nal
+        if NAL_TYPE_IDR in unit.nal_types:
+            # IDR开始新的GOP
+            self._gop = []
+            self._bytes = 0
+            self.generation += 1
+            self.truncated = False
+            self._append(unit)
+        elif self._gop:
+            self._append(unit)
+        self.updated = time.monotonic()
+
+    def _append(self, unit: AccessUnit):
+        # 超出预算后不再缓存 观众从IDR开始解码 直到下一个IDR前可能有少量花屏
+        if self._bytes + len(unit) > self.max_bytes:
+            self.truncated = True
+            return
+        self._gop.append(unit)
+        self._bytes += len(unit)
+
+    def frames(self) -> list:
+        if not (self.sps and self.pps and self._gop):
+            return []
+        frames = [unit.data for unit in self._gop]
+        if NAL_TYPE_SPS not in self._gop[0].nal_types:
+            frames[0] = self.sps + self.pps + frames[0]
+        return frames
+
+    def age(self) -> float:
+        """最近一帧距今的秒数 没有可解码的画面时为None"""
+        if self.updated is None or self.truncated or not self._gop:
+            return None
+        return time.monotonic() - self.updated
+
+    def clear(self):
+        self.sps = None
+        self.pps = None
+        self._gop = []
+        self._bytes = 0
+        self.updated = None
+        self.truncated = False
+
+
+class Broadcaster:
+    """将视频流并发推送给所有观众 观众之间互不阻塞"""
+
+    def __init__(self, max_bytes=1 << 20):
+        self.max_bytes = max_bytes
+        self._viewers = dict()
+
+    def __len__(self):
+        return len(self._viewers)
+
+    def __iter__(self):
+        return iter(list(self._viewers))
+
+    def add(self, ws_client):
+        if ws_client not in self._viewers:
+            self._viewers[ws_client] = Viewer(ws_client, self.max_bytes)
+        return self._viewers[ws_client]
+
+    def join(self, ws_client, frames: list):
+        """新观众加入正在运行的会话 先发送缓存的GOP(从IDR开始)"""
+        viewer = self.add(ws_client)
+        if frames:
+            viewer.put_burst(frames)
+        else:
+            # 还没有缓存到关键帧 等待下一个SPS/IDR再开始推送
+            viewer.skip_to_keyframe()
+        return viewer
+
+    def remove(self, ws_client):
+        viewer = self._viewers.pop(ws_client, None)
+        if viewer:
+            viewer.close()
+
+    def publish(self, data: bytes, keyframe: bool):
+        for viewer in list(self._viewers.values()):
+            viewer.put(data, keyframe)
+
+    def close(self):
+        for ws_client in list(self._viewers):
+            self.remove(ws_client)
@@ -4,10 +4,20 @@ import subprocess
 from bitstring import BitStream
 from h26x_extractor.nalutypes import SPS
 from scrcpy.controller import Controller
+from scrcpy.annexb import AnnexBParser, AccessUnitAssembler, NAL_TYPE_SPS
+from scrcpy.broadcast import Broadcaster, KeyframeCache, gop_budget
+from scrcpy.encoder import parse_encoders, select_encoder, PROBE_ENCODER
+from scrcpy.profile import build_profiles, highest, DEFAULT_PROFILE
+from scrcpy.snapshot import SnapshotDecoder
 from logzero import logger
 from adb import adb
 
 
+# scrcpy 1.24 frame meta: pts(8字节 最高位为config标记) + 数据包长度(4字节)
+FRAME_META_SIZE = 12
+PACKET_FLAG_CONFIG = 1 << 63
+
+
 class ClientDevice:
     @classmethod
     async def cancel_task(cls, task):
@@ -25,15 +35,28 @@ class ClientDevice:
             print(f"task await exception {type(e)}, {e}")
 
     def __init__(self, device_id,
-                 max_size=720,
-                 bit_rate=1280000,
-                 max_fps=25,
+                 max_size=None,
+                 bit_rate=None,
+                 max_fps=None,
+                 encoder_name=None,
+                 codec_options="profile=1,level=2",
                  connect_timeout=300):
         self.device_id = device_id
-        # scrcpy_server启动参数
-        self.max_size = max_size
-        self.bit_rate = bit_rate
-        self.max_fps = max_fps
+        # 最近的SPS/PPS/IDR 供新加入的观众直接解码 缓存上限随档位码率调整
+        self.keyframe_cache = KeyframeCache()
+        # scrcpy_server启动参数 由当前画质档位决定
+        self.profiles = build_profiles(max_size, bit_rate, max_fps)
+        self.profile = None
+        self.max_size = None
+        self.bit_rate = None
+        self.max_fps = None
+        self.apply_profile(DEFAULT_PROFILE)
+        # 每个观众需要的画质档位
+        self.viewer_profiles = dict()
+        # 编码器 未指定时启动前自动探测并优先使用硬件编码器
+        self.encoder_name = encoder_name
+        self.codec_options = codec_options
+        self.encoders = None
         # adb socket连接超时时间
         self.connect_timeout = connect_timeout
         # scrcpy连接
@@ -49,13 +72,49 @@ class ClientDevice:
         self.device_lock = asyncio.Lock()
         # 设备控制器
         self.controller = Controller(self)
-        # 需要推流得ws_client
-        self.ws_client_list = list()
+        # 需要推流得ws_client 每个观众独立发送队列
+        self.broadcaster = Broadcaster()
+        # 截图时按需解码最新画面
+        self.snapshot_decoder = SnapshotDecoder()
+        self.snapshot_lock = asyncio.Lock()
         # 需要推操作失败的ws_client
         self.ws_touch_list = list()
 
-    async def prepare_server(self):
-        commands2 = [
+    def apply_profile(self, name):
+        values = self.profiles[name]
+        self.max_size = values["max_size"]
+        self.bit_rate = values["bit_rate"]
+        self.max_fps = values["max_fps"]
+        self.profile = name
+        # 上限过小时GOP被截断 截图接口将无法使用投屏画面
+        self.keyframe_cache.max_bytes = gop_budget(self.bit_rate)
+
+    def set_viewer_profile(self, ws_client, name):
+        if name not in self.profiles:
+            raise ValueError("unknown profile: %s" % name)
+        self.viewer_profiles[ws_client] = name
+
+    def remove_viewer(self, ws_client):
+        self.broadcaster.remove(ws_client)
+        self.viewer_profiles.pop(ws_client, None)
+
+    def target_profile(self):
+        """所有观众中最高的档位 没有观众时保持当前档位"""
+        return highest(self.viewer_profiles.values()) or self.profile
+
+    async def update_profile(self):
+        """最高档位变化时才重启编码 否则继续使用当前视频流"""
+        async with self.device_lock:
+            target = self.target_profile()
+            if target == self.profile or not self.alive:
+                return
+            logger.info("[%s] switch profile %s -> %s" % (self.device_id, self.profile, target))
+            self.apply_profile(target)
+            await self.stop()
+            await self.start()
+
+    def server_command(self, encoder_name):
+        return [
             "adb", "-s", self.device_id, "shell",
             "CLASSPATH=/data/local/tmp/scrcpy-server",
             "app_process",
@@ -72,18 +131,21 @@ class ClientDevice:
             f"display_id=0",  # Display id
             f"show_touches=true",  # Show touches
             f"stay_awake=false",  # scrcpy server Stay awake
-            f"codec_options=profile=1,level=2",  # Codec (video encoding) options
-            f"encoder_name=OMX.google.h264.encoder",  # Encoder name
+            f"codec_options={self.codec_options}",  # Codec (video encoding) options
+            f"encoder_name={encoder_name}",  # Encoder name
             f"power_off_on_close=false",  # Power off screen after server closed
             "clipboard_autosync=false",  # auto sync clipboard
             f"downsize_on_error=true",   # when encode screen error downsize and retry encode screen
             "cleanup=true",     # enable cleanup thread
             f"power_on=true",   # power on when scrcpy deploy
             "send_device_meta=true",    # send device name, device resolution when video socket connect
-            f"send_frame_meta=false",    # receive frame_meta,
+            f"send_frame_meta=true",    # receive frame_meta, 每个编码数据包前有pts和长度 用于确定帧边界
             "send_dummy_byte=true",     # send dummy byte when video socket connect
             "raw_video_stream=false",  # video_socket just receive raw_video_stream
         ]
+
+    async def prepare_server(self):
+        commands2 = self.server_command(self.encoder_name)
         self.deploy_shell_socket = subprocess.Popen(commands2, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         res = self.deploy_shell_socket.stdout.readlines(3)
         if len(res) == 1 and "Device" in res[0].decode():
@@ -91,7 +153,7 @@ class ClientDevice:
         else:
             logger.info("[%s] start scrcpy error" % self.device_id)
             self.deploy_shell_socket = None
-            for ws_client in self.ws_client_list:
+            for ws_client in self.broadcaster:
                 ws_client.close()
             raise ConnectionError("启动scrcpy服务失败")
 
@@ -110,17 +172,36 @@ class ClientDevice:
         self.resolution = struct.unpack(">HH", await self.video_socket.read_exactly(4))
 
     async def _video_task(self):
+        """
+        按frame meta读取完整的编码数据包 数据包结束即一帧结束 收到后立即推送
+        config数据包(SPS/PPS)与下一帧合并为一个访问单元
+        """
+        parser = AnnexBParser()
+        assembler = AccessUnitAssembler()
         while True:
             try:
-                data = await self.video_socket.read_bytes_until(b'\x00\x00\x00\x01', None)
-                current_nal_data = b'\x00\x00\x00\x01' + data.rstrip(b'\x00\x00\x00\x01')
-                self.update_resolution(current_nal_data)
-                for ws_client in self.ws_client_list:
-                    await ws_client.write_message(current_nal_data, True)
+                pts, size = struct.unpack(">QI", await self.video_socket.read_exactly(FRAME_META_SIZE))
+                packet = await self.video_socket.read_exactly(size)
+                for nal in parser.feed(packet) + parser.flush():
+                    unit = assembler.push(nal)
+                    if unit:
+                        self.publish_unit(unit)
+                if not pts & PACKET_FLAG_CONFIG:
+                    unit = assembler.flush()
+                    if unit:
+                        self.publish_unit(unit)
             except:
                 logger.info("[%s] scrcpy error" % self.device_id)
                 break
 
+    def publish_unit(self, unit):
+        """按访问单元(一帧)推送 每帧只发送一条ws消息"""
+        for nal, t in zip(unit.nals, unit.nal_types):
+            if t == NAL_TYPE_SPS:
+                self.update_resolution(nal)
+        self.keyframe_cache.update(unit)
+        self.broadcaster.publish(unit.data, unit.keyframe)
+
     def update_resolution(self, current_nal_data):
         # when read a sps frame, change origin resolution
         if current_nal_data.startswith(b'\x00\x00\x00\x01g'):
@@ -134,12 +215,69 @@ class ClientDevice:
                 resolution = (min(self.resolution), max(self.resolution))
             self.resolution = resolution
 
+    @property
+    def alive(self) -> bool:
+        """scrcpy服务进程和视频流任务是否都在运行"""
+        if not self.deploy_shell_socket or self.deploy_shell_socket.poll() is not None:
+            return False
+        return self.video_task is not None and not self.video_task.done()
+
+    def join(self, ws_client):
+        """观众加入正在运行的scrcpy会话"""
+        return self.broadcaster.join(ws_client, self.keyframe_cache.frames())
+
+    async def snapshot(self, max_age: float) -> bytes:
+        """
+        最新画面的RGB原始数据(screencap格式) 画面超过max_age秒未更新或没有解码器时返回None
+        scrcpy在画面静止时也会重复发送上一帧 所以长时间没有新帧说明视频流已中断
+        """
+        age = self.keyframe_cache.age()
+        if age is None or age > max_age or not self.snapshot_decoder.available():
+            return None
+        generation, frames = self.keyframe_cache.generation, self.keyframe_cache.frames()
+        if not frames:
+            return None
+        async with self.snapshot_lock:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self.snapshot_decoder.decode_raw, generation, frames)
+
+    async def list_encoders(self):
+        """用无效编码器名启动scrcpy 服务端在视频socket连接后打印可用编码器列表并退出"""
+        process = await asyncio.create_subprocess_exec(*self.server_command(PROBE_ENCODER),
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        output = b""
+        try:
+            await self.prepare_socket()
+            output = await asyncio.wait_for(process.stdout.read(), timeout=10)
+        except Exception as e:
+            logger.warning("[%s] list encoders error: %s" % (self.device_id, e))
+        finally:
+            if process.returncode is None:
+                process.kill()
+            for socket in (self.video_socket, self.control_socket):
+                if socket:
+                    await socket.disconnect()
+            self.video_socket = None
+            self.control_socket = None
+        return parse_encoders(output.decode("utf-8", errors="ignore"))
+
+    async def select_encoder(self):
+        if self.encoders is None:
+            self.encoders = await self.list_encoders()
+            logger.info("[%s] available encoders: %s" % (self.device_id, self.encoders))
+        self.encoder_name = select_encoder(self.encoders)
+        logger.info("[%s] use encoder: %s" % (self.device_id, self.encoder_name))
+
     async def start(self):
+        if not self.encoder_name:
+            await self.select_encoder()
         await self.prepare_server()
         await self.prepare_socket()
         self.video_task = asyncio.create_task(self._video_task())
 
     async def stop(self):
+        self.keyframe_cache.clear()
         if self.video_socket:
             await self.video_socket.disconnect()
             self.video_socket = None
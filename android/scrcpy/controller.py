@@ -1,10 +1,52 @@
 import asyncio
+import collections
 import struct
+from logzero import logger
+from scrcpy import gesture
+
+
+# scrcpy 1.24 控制消息类型
+TYPE_INJECT_KEYCODE = 0
+TYPE_INJECT_TEXT = 1
+TYPE_INJECT_TOUCH_EVENT = 2
+TYPE_INJECT_SCROLL_EVENT = 3
+TYPE_BACK_OR_SCREEN_ON = 4
+TYPE_SET_CLIPBOARD = 9
+ACTION_DOWN = 0
+ACTION_UP = 1
+ACTION_MOVE = 2
+# scrcpy服务端单条文本消息的最大字节数
+INJECT_TEXT_MAX_LENGTH = 300
+# 二进制协议允许透传的定长消息及长度
+MESSAGE_SIZES = {
+    TYPE_INJECT_KEYCODE: 14,
+    TYPE_INJECT_TOUCH_EVENT: 28,
+    TYPE_INJECT_SCROLL_EVENT: 25,
+    TYPE_BACK_OR_SCREEN_ON: 2,
+}
+# 带坐标的消息中x,y,width,height字段的偏移
+POSITION_OFFSETS = {
+    TYPE_INJECT_TOUCH_EVENT: 10,
+    TYPE_INJECT_SCROLL_EVENT: 1,
+}
+
+
+def is_touch_move(msg: bytes) -> bool:
+    return len(msg) == MESSAGE_SIZES[TYPE_INJECT_TOUCH_EVENT] and \
+        msg[0] == TYPE_INJECT_TOUCH_EVENT and msg[1] == ACTION_MOVE
 
 
 class Controller:
     def __init__(self, device_client):
         self.device = device_client
+        # 待写入control_socket的消息 由单独的写任务批量发送
+        self._pending = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writer = None
+        self.coalesced = 0
+        self.gestures = gesture.GestureEngine(self)
 
     async def empty_control_socket(self, interval=0.02, loop=10):
         for idx in range(loop):
@@ -14,11 +56,101 @@ class Controller:
                 return
 
     async def inject(self, msg):
-        async with self.device.device_lock:
-            await self.device.control_socket.write_bytes(msg)
+        self.inject_nowait(msg)
+
+    def inject_nowait(self, msg):
+        """
+        消息入队后立即返回 不等待scrcpy重启等耗时操作
+        设备处理不过来时 同一触点连续的ACTION_MOVE只保留最新一条
+        """
+        if is_touch_move(msg) and self._pending:
+            last = self._pending[-1]
+            # pointer id位于第2-9字节
+            if is_touch_move(last) and last[2:10] == msg[2:10]:
+                self._pending[-1] = msg
+                self.coalesced += 1
+                return
+        self._pending.append(msg)
+        self._idle.clear()
+        self._wakeup.set()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_forever())
 
     async def inject_without_lock(self, msg):
-        await self.device.control_socket.write_bytes(msg)
+        await self.inject(msg)
+
+    async def flush(self):
+        """等待已入队的消息全部写入"""
+        await self._idle.wait()
+
+    async def _write_forever(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            batch = b"".join(self._pending)
+            self._pending.clear()
+            socket = self.device.control_socket
+            if socket is None:
+                logger.debug("control socket not ready, drop %d bytes", len(batch))
+            else:
+                try:
+                    await socket.write_bytes(batch)
+                except Exception as e:
+                    logger.info("control socket write error: %s", e)
+            if not self._pending:
+                self._idle.set()
+
+    def close(self):
+        if self._writer:
+            self._writer.cancel()
+            self._writer = None
+        self._pending.clear()
+        self._idle.set()
+
+    def check_binary(self, data: bytes) -> list:
+        """
+        校验二进制控制消息 布局与scrcpy控制消息一致 一帧可以包含多条消息
+        坐标以消息中的width,height为参照 与设备分辨率不一致时按比例换算
+        返回拆分后的消息列表
+        """
+        if not self.device.resolution or not self.device.control_socket:
+            raise ValueError("scrcpy session not ready")
+        view = memoryview(data)
+        msg = None
+        offset = 0
+        bounds = []
+        while offset < len(data):
+            msg_type = data[offset]
+            size = MESSAGE_SIZES.get(msg_type)
+            if size is None:
+                raise ValueError("unsupported message type: %d" % msg_type)
+            if offset + size > len(data):
+                raise ValueError("incomplete message type: %d" % msg_type)
+            position = POSITION_OFFSETS.get(msg_type)
+            if position is not None:
+                x, y, width, height = struct.unpack_from(">iiHH", view, offset + position)
+                res_width, res_height = self.device.resolution
+                if (width, height) != (res_width, res_height):
+                    if not width or not height:
+                        raise ValueError("invalid screen size: %dx%d" % (width, height))
+                    if msg is None:
+                        msg = bytearray(data)
+                    struct.pack_into(">iiHH", msg, offset + position, x * res_width // width,
+                                     y * res_height // height, res_width, res_height)
+            bounds.append((offset, offset + size))
+            offset += size
+        source = data if msg is None else bytes(msg)
+        if len(bounds) == 1:
+            return [source]
+        return [source[begin:end] for begin, end in bounds]
+
+    async def inject_binary(self, data: bytes):
+        messages = self.check_binary(data)
+        for msg in messages:
+            await self.inject(msg)
+        return messages
 
     async def inject_touch_event(self, x, y, action=0, touch_id=-1, pressure=0xFFFF, buttons=1 << 0):
         """
@@ -28,14 +160,17 @@ class Controller:
         buttons: android_motionevent_buttons
         inject_data: lens 28
         """
+        inject_data = self.pack_touch_event(x, y, action, touch_id, pressure, buttons)
+        await self.inject(inject_data)
+        return inject_data
+
+    def pack_touch_event(self, x, y, action=0, touch_id=-1, pressure=0xFFFF, buttons=1 << 0):
         if action == 1:
             pressure = 0x0
         msg_type = 2
         x, y = max(x*self.device.resolution[0], 0), max(y*self.device.resolution[1], 0)
-        inject_data = struct.pack(">BBqiiHHHi", msg_type, action, touch_id, int(x), int(y),
-                                  int(self.device.resolution[0]), int(self.device.resolution[1]), pressure, buttons)
-        await self.inject(inject_data)
-        return inject_data
+        return struct.pack(">BBqiiHHHi", msg_type, action, touch_id, int(x), int(y),
+                           int(self.device.resolution[0]), int(self.device.resolution[1]), pressure, buttons)
 
     async def inject_scroll_event(self, x, y, distance_x, distance_y, buttons=1 << 0):
         """
@@ -49,39 +184,66 @@ class Controller:
         await self.inject(inject_data)
         return inject_data
 
-    async def swipe(self, x, y, end_x, end_y, unit=5, delay=1):
+    async def inject_keycode(self, keycode, action=None, repeat=0, metastate=0):
         """
-        swipe (x,y) to (end_x, end_y), 匀速移动，每unit个像素点出发一次touch move事件
+        keycode: android KeyEvent keycode
+        action: 0按下 1抬起 不传时按下并抬起
+        inject_data: lens 14
         """
-        x_1, y_1 = x*self.device.resolution[0], y*self.device.resolution[1]
-        end_x, end_y = min(end_x*self.device.resolution[0], self.device.resolution[0]), min(end_y*self.device.resolution[1], self.device.resolution[1])
-        step = 1
-        while True:
-            if x_1 > end_x:
-                x_1 -= min(x-end_x, unit)
-            elif x_1 < end_x:
-                x_1 += min(end_x-x_1, unit)
-            if y_1 > end_y:
-                y_1 -= min(y_1-end_y, unit)
-            elif y < end_y:
-                y_1 += min(end_y-y_1, unit)
-            if x_1 == end_x and y_1 == end_y:
-                break
-            step += 1
-        unit_delay = delay/step
-        await self.inject_touch_event(x, y, 0)
-        while True:
-            if x > end_x:
-                x -= min(x-end_x, unit)
-            elif x < end_x:
-                x += min(end_x-x, unit)
-            if y > end_y:
-                y -= min(y-end_y, unit)
-            elif y < end_y:
-                y += min(end_y-y, unit)
-            await self.inject_touch_event(x, y, 2)
-            await asyncio.sleep(unit_delay)
-            if x == end_x and y == end_y:
-                await self.inject_touch_event(x, y, 1)
-                break
+        actions = (ACTION_DOWN, ACTION_UP) if action is None else (action,)
+        inject_data = b"".join(struct.pack(">BBiii", TYPE_INJECT_KEYCODE, a, int(keycode), int(repeat), int(metastate))
+                               for a in actions)
+        await self.inject(inject_data)
+        return inject_data
+
+    async def inject_text(self, text: str):
+        """输入文本 超长文本按字符边界拆分为多条消息"""
+        chunks, chunk = [], b""
+        for char in text:
+            encoded = char.encode("utf-8")
+            if len(chunk) + len(encoded) > INJECT_TEXT_MAX_LENGTH:
+                chunks.append(chunk)
+                chunk = b""
+            chunk += encoded
+        if chunk:
+            chunks.append(chunk)
+        messages = [struct.pack(">Bi", TYPE_INJECT_TEXT, len(c)) + c for c in chunks]
+        for msg in messages:
+            await self.inject(msg)
+        return b"".join(messages)
+
+    async def set_clipboard(self, text: str, paste=False, sequence=0):
+        """设置剪贴板 paste为True时同时粘贴到当前输入框"""
+        encoded = text.encode("utf-8")
+        inject_data = struct.pack(">Bq?i", TYPE_SET_CLIPBOARD, sequence, paste, len(encoded)) + encoded
+        await self.inject(inject_data)
+        return inject_data
+
+    async def swipe(self, x, y, end_x, end_y, unit=5, delay=1, easing="linear"):
+        """
+        swipe (x,y) to (end_x, end_y), delay秒内按帧间隔发送touch move事件
+        unit: 兼容旧版参数 不再使用 采样点数只与时长有关
+        """
+        end_x, end_y = min(end_x, 1), min(end_y, 1)
+        trajectory = gesture.path([(x, y), (end_x, end_y)], delay, gesture.EASINGS[easing])
+        await self.gestures.perform([gesture.Stroke(-1, trajectory)])
+
+    async def swipe_path(self, points, duration=1, easing="linear"):
+        """沿折线滑动 points: [(x, y), ...]"""
+        trajectory = gesture.path([tuple(p) for p in points], duration, gesture.EASINGS[easing])
+        await self.gestures.perform([gesture.Stroke(-1, trajectory)])
+
+    @property
+    def aspect(self) -> float:
+        width, height = self.device.resolution
+        return width / height
+
+    async def pinch(self, x, y, start_distance, end_distance, delay=1, angle=0, easing="linear"):
+        """distance为屏幕宽度的比例"""
+        await self.gestures.perform(gesture.pinch(x, y, start_distance, end_distance, delay,
+                                                  angle, gesture.EASINGS[easing], aspect=self.aspect))
 
+    async def rotate(self, x, y, radius, start_angle, end_angle, delay=1, fingers=2, easing="linear"):
+        """radius为屏幕宽度的比例"""
+        await self.gestures.perform(gesture.rotate(x, y, radius, start_angle, end_angle, delay,
+                                                   fingers, gesture.EASINGS[easing], aspect=self.aspect))
@@ -0,0 +1,37 @@
+import re
+
+
+SOFTWARE_ENCODER = "OMX.google.h264.encoder"
+# 安卓自带的软件编码器前缀
+SOFTWARE_PREFIXES = ("OMX.google.", "c2.android.")
+# 用一个不存在的编码器名启动scrcpy 服务端会打印可用编码器列表后退出
+PROBE_ENCODER = "_"
+
+_ENCODER_PATTERN = re.compile(r"--encoder(?:-name)?[ =]'([^']+)'")
+
+
+def parse_encoders(output: str) -> list:
+    """
+    解析scrcpy服务端输出的H.264编码器列表
+    Example output:
+        [server] ERROR: Encoder '_' not found
+        [server] ERROR: Try to use one of the available encoders:
+        [server] ERROR:     scrcpy --encoder 'OMX.qcom.video.encoder.avc'
+    """
+    encoders = []
+    for name in _ENCODER_PATTERN.findall(output):
+        if name not in encoders:
+            encoders.append(name)
+    return encoders
+
+
+def is_hardware(name: str) -> bool:
+    return not name.startswith(SOFTWARE_PREFIXES)
+
+
+def select_encoder(encoders: list) -> str:
+    """优先选择设备列出的第一个硬件编码器 没有则使用软件编码器"""
+    for name in encoders:
+        if is_hardware(name):
+            return name
+    return SOFTWARE_ENCODER
@@ -0,0 +1,137 @@
+import asyncio
+import bisect
+import itertools
+import math
+from collections import namedtuple
+
+
+ACTION_DOWN = 0
+ACTION_UP = 1
+ACTION_MOVE = 2
+# 手势采样间隔 与屏幕刷新率一致 事件数只和时长有关 与移动距离无关
+FRAME_INTERVAL = 1 / 60
+
+# touch_id: 触点编号 多指手势用不同编号区分; points: [(相对开始的秒数, x, y)] x,y为0~1的相对坐标
+Stroke = namedtuple("Stroke", ["touch_id", "points"])
+
+
+def linear(t: float) -> float:
+    return t
+
+
+def ease_in_out(t: float) -> float:
+    return t * t * (3 - 2 * t)
+
+
+EASINGS = {
+    "linear": linear,
+    "ease": ease_in_out,
+}
+
+
+def _steps(duration: float, interval: float) -> int:
+    return max(1, int(round(duration / interval)))
+
+
+def path(points: list, duration: float, easing=linear, interval=FRAME_INTERVAL) -> list:
+    """折线轨迹 按各段长度分配时间 一次计算出所有采样点"""
+    if len(points) == 1:
+        points = [points[0], points[0]]
+    cumulative = [0.0]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        cumulative.append(cumulative[-1] + math.hypot(x2 - x1, y2 - y1))
+    total = cumulative[-1]
+    steps = _steps(duration, interval)
+    trajectory = []
+    for i in range(steps + 1):
+        progress = i / steps
+        distance = easing(progress) * total
+        index = min(bisect.bisect_right(cumulative, distance), len(points) - 1)
+        (x1, y1), (x2, y2) = points[index - 1], points[index]
+        length = cumulative[index] - cumulative[index - 1]
+        ratio = (distance - cumulative[index - 1]) / length if length else 1.0
+        trajectory.append((duration * progress, x1 + (x2 - x1) * ratio, y1 + (y2 - y1) * ratio))
+    return trajectory
+
+
+def pinch(x: float, y: float, start_distance: float, end_distance: float, duration: float,
+          angle=0.0, easing=linear, interval=FRAME_INTERVAL, aspect=1.0) -> list:
+    """
+    双指缩放 两个触点以(x,y)为中心沿angle方向对称移动 distance为两指间距(屏幕宽度的比例)
+    aspect: 屏幕宽高比 坐标按宽高分别归一化 y方向偏移需乘以宽高比才能在像素空间保持距离
+    """
+    dx, dy = math.cos(angle) / 2, math.sin(angle) / 2 * aspect
+    strokes = []
+    for touch_id, sign in ((0, 1), (1, -1)):
+        start = (x + sign * dx * start_distance, y + sign * dy * start_distance)
+        end = (x + sign * dx * end_distance, y + sign * dy * end_distance)
+        strokes.append(Stroke(touch_id, path([start, end], duration, easing, interval)))
+    return strokes
+
+
+def rotate(x: float, y: float, radius: float, start_angle: float, end_angle: float, duration: float,
+           fingers=2, easing=linear, interval=FRAME_INTERVAL, aspect=1.0) -> list:
+    """
+    多指旋转 触点均匀分布在以(x,y)为圆心的圆上 角度为弧度
+    radius为屏幕宽度的比例 aspect为屏幕宽高比 保证像素空间中是圆而不是椭圆
+    """
+    steps = _steps(duration, interval)
+    strokes = []
+    for touch_id in range(fingers):
+        offset = 2 * math.pi * touch_id / fingers
+        points = []
+        for i in range(steps + 1):
+            progress = i / steps
+            theta = start_angle + (end_angle - start_angle) * easing(progress) + offset
+            points.append((duration * progress, x + radius * math.cos(theta),
+                           y + radius * math.sin(theta) * aspect))
+        strokes.append(Stroke(touch_id, points))
+    return strokes
+
+
+class GestureEngine:
+    """按绝对时间点(loop.call_at)发送手势事件 负载高时不会累积延迟"""
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    @staticmethod
+    def timeline(strokes: list) -> list:
+        """将所有触点的轨迹合并为按时间排序的(offset, action, touch_id, x, y)"""
+        events = []
+        for stroke in strokes:
+            points = stroke.points if len(stroke.points) > 1 else stroke.points * 2
+            last = len(points) - 1
+            for i, (offset, x, y) in enumerate(points):
+                action = ACTION_DOWN if i == 0 else ACTION_UP if i == last else ACTION_MOVE
+                events.append((offset, action, stroke.touch_id, x, y))
+        # 同一时间点先按下再移动最后抬起
+        order = {ACTION_DOWN: 0, ACTION_MOVE: 1, ACTION_UP: 2}
+        events.sort(key=lambda e: (e[0], order[e[1]]))
+        return events
+
+    def perform(self, strokes: list) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        groups = [list(group) for _, group in itertools.groupby(self.timeline(strokes), key=lambda e: e[0])]
+        if not groups:
+            done.set_result(None)
+            return done
+        start = loop.time()
+        handles = []
+        for index, group in enumerate(groups):
+            is_last = index == len(groups) - 1
+            handles.append(loop.call_at(start + group[0][0], self._fire, group, done if is_last else None))
+
+        def _cancel(future):
+            if future.cancelled():
+                for handle in handles:
+                    handle.cancel()
+        done.add_done_callback(_cancel)
+        return done
+
+    def _fire(self, events: list, done):
+        for _, action, touch_id, x, y in events:
+            self.controller.inject_nowait(self.controller.pack_touch_event(x, y, action, touch_id))
+        if done is not None and not done.done():
+            done.set_result(None)
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+
+
+# 投屏画质档位 按画质从低到高排列
+PROFILES = OrderedDict([
+    # 设备墙缩略图
+    ("thumbnail", dict(max_size=360, bit_rate=400000, max_fps=10)),
+    # 在线操作
+    ("interactive", dict(max_size=720, bit_rate=1280000, max_fps=25)),
+    # 高清
+    ("hi-fi", dict(max_size=1080, bit_rate=4000000, max_fps=30)),
+])
+DEFAULT_PROFILE = "interactive"
+
+
+def build_profiles(max_size=None, bit_rate=None, max_fps=None) -> OrderedDict:
+    """机型配置的参数作为interactive档位 其他档位不变"""
+    profiles = OrderedDict((name, dict(values)) for name, values in PROFILES.items())
+    overrides = dict(max_size=max_size, bit_rate=bit_rate, max_fps=max_fps)
+    profiles[DEFAULT_PROFILE].update({k: v for k, v in overrides.items() if v is not None})
+    return profiles
+
+
+def covers(max_size: int, max_side: int = None) -> bool:
+    """长边为max_size的投屏画面能否用于截图 缩略图画质只用于要求的长边不超过画面的请求"""
+    if not max_size or max_size > PROFILES["thumbnail"]["max_size"]:
+        return True
+    return bool(max_side) and max_side <= max_size
+
+
+def highest(names) -> str:
+    """当前观众需要的最高档位 没有观众时返回None"""
+    ranks = list(PROFILES)
+    names = [name for name in names if name in PROFILES]
+    if not names:
+        return None
+    return max(names, key=ranks.index)
@@ -0,0 +1,49 @@
+import struct
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+# 与screencap原始输出格式一致 width,height,format 后接像素 format 3为RGB_888
+RGB_888 = 3
+
+
+class SnapshotDecoder:
+    """
+    按需把缓存的GOP解码为最新一帧 只在请求截图时解码
+    同一GOP内再次请求时只解码新增的访问单元
+    """
+
+    def __init__(self):
+        self._codec = None
+        self._generation = None
+        self._decoded = 0
+        self._frame = None
+
+    @staticmethod
+    def available() -> bool:
+        return av is not None
+
+    def decode(self, generation: int, frames: list):
+        """frames: 从IDR开始的访问单元 返回最后一帧解码结果"""
+        if self._codec is None or generation != self._generation or len(frames) < self._decoded:
+            self._codec = av.CodecContext.create("h264", "r")
+            self._generation = generation
+            self._decoded = 0
+            self._frame = None
+        for data in frames[self._decoded:]:
+            for frame in self._codec.decode(av.Packet(data)):
+                self._frame = frame
+        self._decoded = len(frames)
+        return self._frame
+
+    def decode_raw(self, generation: int, frames: list) -> bytes:
+        """返回screencap格式的RGB原始数据 由主进程按请求参数编码"""
+        frame = self.decode(generation, frames)
+        if frame is None:
+            return None
+        pixels = frame.to_ndarray(format="rgb24")
+        height, width = pixels.shape[:2]
+        return struct.pack("<III", width, height, RGB_888) + pixels.tobytes()
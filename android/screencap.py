@@ -0,0 +1,66 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import multiprocessing
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from tools.imageutil import ImageOptions, encode_image
+
+
+# screencap原始输出的像素格式(android PixelFormat) -> 每像素字节数
+PIXEL_FORMATS = {
+    1: 4,  # RGBA_8888
+    2: 4,  # RGBX_8888
+    3: 3,  # RGB_888
+}
+# 头部为width,height,format 安卓9以后多一个colorspace
+HEADER_SIZES = (12, 16)
+
+_encode_pool = None
+
+
+def parse_header(data: bytes) -> tuple:
+    """校验screencap输出 返回(width, height, 每像素字节数, 头部长度)"""
+    if len(data) < HEADER_SIZES[0]:
+        raise ValueError("screencap output too short: %d bytes" % len(data))
+    width, height, pixel_format = struct.unpack_from("<III", data)
+    bpp = PIXEL_FORMATS.get(pixel_format)
+    if bpp is None:
+        raise ValueError("unsupported pixel format: %d" % pixel_format)
+    header = len(data) - width * height * bpp
+    if header not in HEADER_SIZES:
+        raise ValueError("invalid screencap size %d for %dx%d" % (len(data), width, height))
+    return width, height, bpp, header
+
+
+def to_rgb(data: bytes) -> np.ndarray:
+    """原始像素转为(height, width, 3)的数组视图 不复制数据"""
+    width, height, bpp, header = parse_header(data)
+    pixels = np.frombuffer(data, dtype=np.uint8, count=width * height * bpp, offset=header)
+    return pixels.reshape(height, width, bpp)[:, :, :3]
+
+
+def to_image(data: bytes) -> Image.Image:
+    return Image.fromarray(np.ascontiguousarray(to_rgb(data)), "RGB")
+
+
+def encode_screencap(data: bytes, options: ImageOptions) -> bytes:
+    """在进程池中执行 转换和编码都不占用主进程"""
+    return encode_image(to_image(data), options)
+
+
+def encode_pool() -> ProcessPoolExecutor:
+    """
+    所有设备共用的编码进程池 多台设备可以同时利用多个核编码
+    创建时主进程已有多个线程 fork有死锁风险 使用spawn启动子进程
+    """
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ProcessPoolExecutor(max(1, (os.cpu_count() or 2) - 1),
+                                           mp_context=multiprocessing.get_context("spawn"))
+    return _encode_pool
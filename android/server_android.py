@@ -1,26 +1,31 @@
 # coding: utf-8
 # copyright by codeskyblue of openATX
+import asyncio
 import base64
 import hashlib
-import io
 import json
 import os
 import re
 import shutil
 import time
 import traceback
+from functools import partial
 import requests
 import tornado.web
 import tornado.websocket
 from tornado.concurrent import run_on_executor
 from tornado.ioloop import IOLoop
-from adbutils import adb as adbclient, errors
+from adbutils import adb as adbclient
 from tornado.log import enable_pretty_logging
 from concurrent.futures import ThreadPoolExecutor
 from logzero import logger
 from android.adb import adb
-from android.device_android import AndroidDevice
+from android.device_android import AndroidDevice, invalidate_properties
+from android.forward_registry import forward_registry
 from tools.freeport import FreePort
+from tools import imageutil
+from tools.histogram import Histogram
+from tools.looplag import LoopLagMonitor
 from tools.config import config
 from tools.download import get_all
 from tools.heartbeat import heartbeat_connect, HeartbeatConnection, DEVICES
@@ -28,6 +33,10 @@ from tools.heartbeat import heartbeat_connect, HeartbeatConnection, DEVICES
 
 HBC_ANDROID = HeartbeatConnection()
 FREE_PORT = FreePort("android")
+# 每台设备正在处理的上下线任务
+ONBOARD_TASKS = dict()
+# 设备从接入到就绪的耗时分布
+READY_LATENCY = Histogram()
 
 
 class CorsMixin(object):
@@ -44,7 +53,6 @@ class CorsMixin(object):
 
 class AppInstallHandler(CorsMixin, tornado.web.RequestHandler):
     """安装应用"""
-    _install_executor = ThreadPoolExecutor(4)
     _download_executor = ThreadPoolExecutor(1)
 
     def cache_filepath(self, text: str):
@@ -79,19 +87,23 @@ class AppInstallHandler(CorsMixin, tornado.web.RequestHandler):
         os.rename(tmp_path, file_path)
         return file_path
 
-    @run_on_executor(executor='_install_executor')
-    def app_install_url(self, serial: str, apk_path: str):
-        device = adbclient.device(serial)
+    async def app_install_url(self, serial: str, apk_path: str):
+        # 推送到手机
+        dst = "/data/local/tmp/tmp-%d.apk" % int(time.time() * 1000)
         try:
-            # 推送到手机
-            dst = "/data/local/tmp/tmp-%d.apk" % int(time.time() * 1000)
-            device.sync.push(apk_path, dst)
+            await adb.push(serial, apk_path, dst, 0o644)
             # 调用pm install安装
-            device.install_remote(dst)
-        except errors.AdbInstallError as e:
+            result = await adb.shell_v2(serial, "pm install -r -t " + dst)
+        finally:
+            # 安装失败、超时或被取消时也删除推送的安装包
+            try:
+                await adb.shell(serial, "rm -f " + dst)
+            except Exception as e:
+                logger.warning("%s remove %s error: %s", serial, dst, e)
+        if result.exit_code != 0 or "Success" not in result.stdout:
             return {
                 "status": 1000,
-                "message": "安装失败: \n%s" % e.output
+                "message": "安装失败: \n%s" % (result.stderr or result.stdout)
             }
         return {
             "status": 0,
@@ -149,9 +161,7 @@ class DeviceScreenshotHandler(CorsMixin, tornado.web.RequestHandler):
             return
         device = DEVICES[serial]
         try:
-            buffer = io.BytesIO()
-            device.get_screenshot().convert("RGB").save(buffer, format='JPEG')
-            b64data = base64.b64encode(buffer.getvalue())
+            b64data = base64.b64encode(await device.get_screenshot_jpeg())
             res = {
                 "type": "jpeg",
                 "encoding": "base64",
@@ -164,6 +174,31 @@ class DeviceScreenshotHandler(CorsMixin, tornado.web.RequestHandler):
             self.write({"status": 1000, "message": "获取截图错误: %s" % traceback.format_exc()})
 
 
+class DeviceScreenshotBinHandler(CorsMixin, tornado.web.RequestHandler):
+    """ 设备截图 直接返回图片 支持format/quality/scale/max_side/grayscale参数 """
+
+    async def get(self):
+        serial = self.get_argument("serial")
+        assert serial
+        if serial not in DEVICES:
+            self.write({"status": 1000, "message": "设备不存在"})
+            return
+        device = DEVICES[serial]
+        try:
+            options = imageutil.parse_options(self.get_argument)
+        except ValueError as e:
+            self.write({"status": 1000, "message": "参数错误: %s" % str(e)})
+            return
+        try:
+            data = await device.get_screenshot_encoded(options)
+            self.set_header("Content-Type", imageutil.content_type(options))
+            self.write(data)
+        except EnvironmentError as e:
+            self.write({"status": 1000, "message": "获取截图失败: %s" % str(e)})
+        except RuntimeError:
+            self.write({"status": 1000, "message": "获取截图错误: %s" % traceback.format_exc()})
+
+
 class DeviceHierarchyHandler(CorsMixin, tornado.web.RequestHandler):
     """ 设备控件 """
     async def get(self):
@@ -173,64 +208,119 @@ class DeviceHierarchyHandler(CorsMixin, tornado.web.RequestHandler):
             return
         device = DEVICES[serial]
         try:
-            hierachy = device.dump_hierarchy()
+            hierachy = await device.dump_hierarchy()
             self.write({"status": 0, "message": "获取控件成功", "data": hierachy})
         except Exception as e:
             self.write({"status": 1000, "message": "获取控件失败: %s" % str(e)})
 
 
+class DeviceMetricsHandler(CorsMixin, tornado.web.RequestHandler):
+    """ 设备就绪耗时、adb命令耗时和截图缓存命中情况 """
+
+    async def get(self):
+        self.write({"status": 0, "message": "获取统计成功", "data": {
+            "readyLatency": READY_LATENCY.as_dict(),
+            "adbLatency": adb.latency_report(),
+            "screenshotCache": {serial: device.screenshot_cache.as_dict() for serial, device in DEVICES.items()},
+        }})
+
+
 def make_app():
     setting = {'debug': False}
     app = tornado.web.Application([
         (r"/app/install", AppInstallHandler),
         (r"/app/uninstall", AppUninstallHandler),
         (r"/device/screenshot", DeviceScreenshotHandler),
+        (r"/device/screenshot\.bin", DeviceScreenshotBinHandler),
         (r"/device/hierarchy", DeviceHierarchyHandler),
+        (r"/device/metrics", DeviceMetricsHandler),
         # (r"/cold", ColdingHandler),
     ], **setting)
     return app
 
 
+async def device_online(serial: str, start: float):
+    """设备上线 初始化完成后通知流马"""
+    device = AndroidDevice(serial, FREE_PORT)
+    try:
+        await device.init()
+        await device.open_identify()
+        DEVICES[serial] = device
+        await HBC_ANDROID.device_update({
+            "command": "init",
+            "serial": serial,
+            "agent": device.addrs,
+            "properties": await device.properties()
+        })
+        cost = time.time() - start
+        READY_LATENCY.observe(cost)
+        logger.info("Device:%s is ready in %.1fs", serial, cost)
+        logger.info("Device ready latency: %s", READY_LATENCY)
+    except asyncio.CancelledError:
+        # 初始化过程中设备已下线
+        logger.info("Device:%s initialize cancelled", serial)
+        device.close()
+        raise
+    except RuntimeError:
+        logger.warning("Device:%s initialize failed", serial)
+    except Exception as e:
+        logger.error("Unknown error: %s", e)
+        traceback.print_exc()
+
+
+async def device_offline(serial: str):
+    """设备下线"""
+    if serial in DEVICES:
+        DEVICES[serial].close()
+        DEVICES.pop(serial, None)
+    await forward_registry.remove_device(serial)
+
+    await HBC_ANDROID.device_update({
+        "command": "delete",
+        "serial": serial
+    })
+
+
+async def handle_event(event, previous, limit: asyncio.Semaphore, start: float):
+    # 同一设备的事件按顺序处理 等待上一个事件(已被取消)结束
+    if previous:
+        await asyncio.wait([previous])
+    if event.present:
+        async with limit:
+            await device_online(event.serial, start)
+    else:
+        await device_offline(event.serial)
+
+
 async def device_watch():
-    """监听安卓设备"""
+    """监听安卓设备 每台设备独立任务初始化 并发数受配置限制"""
+    limit = asyncio.Semaphore(int(config.android_init_concurrency))
     async for event in adb.track_devices():
         if re.match(r"(\d+)\.(\d+)\.(\d+)\.(\d+):(\d+)", event.serial):
             logger.debug("Skip remote device: %s", event)
             continue
         logger.debug("Android Event: %s", event)
         serial = event.serial
-        if event.present:
-            try:
-                device = AndroidDevice(event.serial, FREE_PORT)
-                await device.init()
-                await device.open_identify()
-                DEVICES[serial] = device
-                await HBC_ANDROID.device_update({
-                    "command": "init",
-                    "serial": serial,
-                    "agent": device.addrs,
-                    "properties": await device.properties()
-                })
-                logger.info("Device:%s is ready", event.serial)
-            except RuntimeError:
-                logger.warning("Device:%s initialize failed", event.serial)
-            except Exception as e:
-                logger.error("Unknown error: %s", e)
-                import traceback
-                traceback.print_exc()
-        else:
-            if serial in DEVICES:
-                DEVICES[serial].close()
-                DEVICES.pop(serial, None)
+        # 设备重新连接后属性可能变化(如系统升级)
+        invalidate_properties(serial)
+        previous = ONBOARD_TASKS.get(serial)
+        if previous and not previous.done():
+            # 设备下线时取消还在进行中的初始化
+            previous.cancel()
+        task = asyncio.ensure_future(handle_event(event, previous, limit, time.time()))
+        ONBOARD_TASKS[serial] = task
+        task.add_done_callback(partial(_onboard_done, serial))
+
 
-            await HBC_ANDROID.device_update({
-                "command": "delete",
-                "serial": serial
-            })
+def _onboard_done(serial: str, task: asyncio.Task):
+    if ONBOARD_TASKS.get(serial) is task:
+        ONBOARD_TASKS.pop(serial)
 
 
 async def async_main():
     enable_pretty_logging()
+    LoopLagMonitor().start()
+    adb.listen_all = config.android_forward_mode == "direct"
     app = make_app()
     app.listen(config.android_port)
     get_all()  # 下载安卓所有依赖包
@@ -2,20 +2,25 @@
 # copyright by codeskyblue of openATX
 
 import base64
+import io
 import json
 import sys
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import tornado
 import wda
 import tidevice
 from logzero import logger
+from PIL import Image
 from tornado import httpclient, locks
 from tornado.ioloop import IOLoop
 from weditor.web import uidumplib
 from tools.config import config
 from tools.freeport import FreePort
+from tools.imageutil import ImageOptions, encode_image, is_plain_jpeg
+from tools.screencache import ScreenshotCache
 from apple.idb import idb
 
 
@@ -37,6 +42,9 @@ class WDADevice(object):
         self._finished = locks.Event()
         self._stop = locks.Event()
         self._callback = partial(callback, self)
+        # 截图和编码在设备独立的线程池执行 不阻塞IOLoop
+        self._executor = ThreadPoolExecutor(2, thread_name_prefix="apple-" + serial)
+        self.screenshot_cache = ScreenshotCache(config.screenshot_cache_ttl)
         self.get_info()
 
     def get_info(self):
@@ -72,6 +80,8 @@ class WDADevice(object):
         await self._finished.wait()
         logger.debug("%s wda stopped!", self)
         self._finished.clear()
+        # 设备下线 重新接入时会创建新的WDADevice
+        self._executor.shutdown(wait=False)
 
     async def run_wda_forever(self):
         wda_fail_cnt = 0
@@ -315,6 +325,39 @@ class WDADevice(object):
         await client.fetch(self.wda_device_url + "/wda/healthcheck")
         await self._callback(status_ready)
 
+    async def get_screenshot_encoded(self, options: ImageOptions) -> bytes:
+        """按指定格式、质量、尺寸编码截图 并发请求共享同一次截图"""
+        return await self.screenshot_cache.get(options, self._capture,
+                                               lambda frame: self._encode_frame(frame, options))
+
+    async def _capture(self):
+        """优先使用MJPEG流的最新一帧(jpeg) 不可用时通过WDA或tidevice截图"""
+        frame = await self._mjpeg_frame()
+        if frame:
+            return frame
+        return await IOLoop.current().run_in_executor(self._executor, self.get_screenshot)
+
+    async def _mjpeg_frame(self) -> bytes:
+        if not self._wda_proxy_proc or self._wda_proxy_proc.poll() is not None:
+            return None
+        try:
+            request = httpclient.HTTPRequest("http://127.0.0.1:%d/screenshot.jpg?max_age=%s"
+                                             % (self._wda_proxy_port, config.mjpeg_frame_max_age),
+                                             connect_timeout=1, request_timeout=3)
+            resp = await httpclient.AsyncHTTPClient().fetch(request)
+            return resp.body
+        except Exception as e:
+            logger.debug("%s mjpeg frame error: %s", self, e)
+            return None
+
+    async def _encode_frame(self, frame, options: ImageOptions) -> bytes:
+        # 未要求特定质量、尺寸的jpeg请求原样返回 不重新编码
+        if isinstance(frame, bytes) and is_plain_jpeg(options):
+            return frame
+        if isinstance(frame, bytes):
+            frame = Image.open(io.BytesIO(frame))
+        return await IOLoop.current().run_in_executor(self._executor, encode_image, frame, options)
+
     def get_screenshot(self):
         try:
             client = wda.Client(self.wda_device_url)
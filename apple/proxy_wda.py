@@ -2,7 +2,9 @@
 # copyright by codeskyblue of openATX
 
 import argparse
+import asyncio
 import socket
+import time
 import urllib.request
 
 import httpx
@@ -33,6 +35,9 @@ class MjpegReader():
     """
     def __init__(self, url: str):
         self._url = url
+        # 任一连接读到的最新一帧及其接收时间 供截图直接使用
+        self.latest = None
+        self.updated = None
 
     async def aiter_content(self):
         """
@@ -60,10 +65,22 @@ class MjpegReader():
                     continue
                 length = int(line.decode('utf-8').split(": ")[1])
                 await stream.read_until(b"\r\n")
-                yield await stream.read_bytes(length)
+                content = await stream.read_bytes(length)
+                self.latest, self.updated = content, time.monotonic()
+                yield content
         finally:
             stream.close()
 
+    async def latest_frame(self, max_age: float) -> bytes:
+        """最新一帧超过max_age秒时 新建连接读取一帧 MJPEG服务连接后会立即发送当前画面"""
+        if self.latest and time.monotonic() - self.updated <= max_age:
+            return self.latest
+        frames = self.aiter_content()
+        try:
+            return await frames.__anext__()
+        finally:
+            await frames.aclose()
+
 
 class CorsMixin:
     def initialize(self):
@@ -102,6 +119,24 @@ class ScreenWSHandler(CorsMixin, WebSocketHandler):
         return super().on_close()
 
 
+class ScreenshotHandler(CorsMixin, tornado.web.RequestHandler):
+    """MJPEG流的最新一帧 直接返回jpeg 不重新编码"""
+    MJPEG_READER = None
+    TIMEOUT = 2
+
+    async def get(self):
+        assert self.MJPEG_READER
+        max_age = float(self.get_argument("max_age", "0.5"))
+        try:
+            content = await asyncio.wait_for(self.MJPEG_READER.latest_frame(max_age), self.TIMEOUT)
+        except Exception as e:
+            self.set_status(503)
+            self.write({"status": 1000, "message": "获取画面失败: %s" % str(e)})
+            return
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(content)
+
+
 # Ref: https://github.com/colevscode/quickproxy/blob/master/quickproxy/proxy.py
 class ReverseProxyHandler(CorsMixin, tornado.web.RequestHandler):
     # 超时时间手动设长，避免一些耗时操作（如获取元素树）直接超时失败
@@ -143,11 +178,12 @@ def main():
                         help="mjpeg server url")
     args = parser.parse_args()
 
-    ScreenWSHandler.MJPEG_READER = MjpegReader(args.mjpeg_url)
+    ScreenWSHandler.MJPEG_READER = ScreenshotHandler.MJPEG_READER = MjpegReader(args.mjpeg_url)
     ReverseProxyHandler.TARGET_URL = args.wda_url
 
     app = tornado.web.Application([
         (r"/screen", ScreenWSHandler),
+        (r"/screenshot\.jpg", ScreenshotHandler),
         (r"/.*", ReverseProxyHandler),
     ])
     app.listen(args.port)
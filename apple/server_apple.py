@@ -3,7 +3,6 @@
 
 import base64
 import hashlib
-import io
 import json
 import os
 import shutil
@@ -20,6 +19,7 @@ from tornado.log import enable_pretty_logging
 from concurrent.futures import ThreadPoolExecutor
 from apple import device_apple
 from apple.idb import idb
+from tools import imageutil
 from tools.freeport import FreePort
 from tools.config import config
 from tools.heartbeat import heartbeat_connect, HeartbeatConnection, DEVICES
@@ -146,9 +146,7 @@ class DeviceScreenshotHandler(CorsMixin, tornado.web.RequestHandler):
             return
         device = DEVICES[serial]
         try:
-            buffer = io.BytesIO()
-            device.get_screenshot().convert("RGB").save(buffer, format='JPEG')
-            b64data = base64.b64encode(buffer.getvalue())
+            b64data = base64.b64encode(await device.get_screenshot_encoded(imageutil.JSON_OPTIONS))
             res = {
                 "type": "jpeg",
                 "data": b64data.decode('utf-8'),
@@ -160,6 +158,31 @@ class DeviceScreenshotHandler(CorsMixin, tornado.web.RequestHandler):
             self.write({"status": 1000, "message": "获取截图错误: %s" % traceback.format_exc()})
 
 
+class DeviceScreenshotBinHandler(CorsMixin, tornado.web.RequestHandler):
+    """ 设备截图 直接返回图片 支持format/quality/scale/max_side/grayscale参数 """
+
+    async def get(self):
+        serial = self.get_argument("serial")
+        assert serial
+        if serial not in DEVICES:
+            self.write({"status": 1000, "message": "设备不存在"})
+            return
+        device = DEVICES[serial]
+        try:
+            options = imageutil.parse_options(self.get_argument)
+        except ValueError as e:
+            self.write({"status": 1000, "message": "参数错误: %s" % str(e)})
+            return
+        try:
+            data = await device.get_screenshot_encoded(options)
+            self.set_header("Content-Type", imageutil.content_type(options))
+            self.write(data)
+        except EnvironmentError as e:
+            self.write({"status": 1000, "message": "获取截图失败: %s" % str(e)})
+        except RuntimeError:
+            self.write({"status": 1000, "message": "获取截图错误: %s" % traceback.format_exc()})
+
+
 class DeviceHierarchyHandler(CorsMixin, tornado.web.RequestHandler):
     """ 设备控件 """
 
@@ -182,6 +205,7 @@ def make_app():
         (r"/app/install", AppInstallHandler),
         (r"/app/uninstall", AppUnInstallHandler),
         (r"/device/screenshot", DeviceScreenshotHandler),
+        (r"/device/screenshot\.bin", DeviceScreenshotBinHandler),
         (r"/device/hierarchy", DeviceHierarchyHandler),
     ], **setting)
 
@@ -16,9 +16,11 @@ class IniReader:
         else:
             raise FileNotFoundError('文件不存在！')
 
-    def data(self, section, option):
+    def data(self, section, option, fallback=None):
         config = configparser.ConfigParser()
         config.read(self.ini_file, encoding="utf-8")
+        if fallback is not None and not config.has_option(section, option):
+            return fallback
         value = config.get(section, option)
         return value
 
@@ -31,6 +33,11 @@ class IniReader:
             option[key] = self.data(section, key)
         return option
 
+    def sections(self):
+        config = configparser.ConfigParser()
+        config.read(self.ini_file, encoding="utf-8")
+        return config.sections()
+
     def modify(self, section, option, value):
         config = configparser.ConfigParser()
         config.read(self.ini_file, encoding="utf-8")
@@ -51,6 +58,19 @@ class LMConfig(object):
         self.wda_bundle_id = reader.data("StartParam", "wda-bundle-id")
         self.owner = reader.data("StartParam", "owner")
         self.project = reader.data("StartParam", "project")
+        self.android_init_concurrency = reader.data("StartParam", "android-init-concurrency", fallback="4")
+        self.android_forward_mode = reader.data("StartParam", "android-forward-mode", fallback="relay")
+        # 截图缓存时间 单位秒
+        self.screenshot_cache_ttl = int(reader.data("StartParam", "screenshot-cache-ttl", fallback="0")) / 1000
+        # 截图使用投屏画面时允许的最大画面延迟 单位秒
+        self.scrcpy_frame_max_age = int(reader.data("StartParam", "scrcpy-frame-max-age", fallback="500")) / 1000
+        # 苹果截图使用MJPEG画面时允许的最大画面延迟 单位秒
+        self.mjpeg_frame_max_age = int(reader.data("StartParam", "mjpeg-frame-max-age", fallback="500")) / 1000
+        # 按机型覆盖scrcpy参数 [Scrcpy:机型]
+        self.scrcpy_models = {
+            section.split(":", 1)[1].strip(): reader.option(section)
+            for section in reader.sections() if section.startswith("Scrcpy:")
+        }
 
 
 config = LMConfig()
@@ -0,0 +1,35 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import bisect
+
+
+class Histogram(object):
+    """按固定分桶统计耗时(秒)"""
+
+    def __init__(self, buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300)):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self) -> dict:
+        labels = ["<=%ss" % b for b in self.buckets] + [">%ss" % self.buckets[-1]]
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+    def __str__(self):
+        data = self.as_dict()
+        buckets = " ".join("%s:%d" % (k, v) for k, v in data["buckets"].items() if v)
+        return "count=%d avg=%.1fs max=%.1fs %s" % (data["count"], data["avg"], data["max"], buckets)
@@ -0,0 +1,80 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import io
+from collections import namedtuple
+
+from PIL import Image
+
+
+# 格式 -> (PIL格式, Content-Type)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+DEFAULT_QUALITY = 80
+
+# quality: 为None时表示未指定 使用DEFAULT_QUALITY
+# scale: 0~1缩放比例 max_side: 长边最大像素 同时指定时取较小的结果
+ImageOptions = namedtuple("ImageOptions", ["format", "quality", "scale", "max_side", "grayscale"])
+DEFAULT_OPTIONS = ImageOptions("jpeg", DEFAULT_QUALITY, None, None, False)
+# json截图接口沿用PIL默认的jpeg质量
+JSON_OPTIONS = ImageOptions("jpeg", 75, None, None, False)
+
+
+def parse_options(get_argument) -> ImageOptions:
+    """从请求参数解析编码参数 参数非法时抛出ValueError"""
+    fmt = get_argument("format", "jpeg").lower()
+    if fmt not in FORMATS:
+        raise ValueError("unsupported format: %s" % fmt)
+    quality = get_argument("quality", None)
+    quality = int(quality) if quality else None
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality should be 1~100")
+    scale = get_argument("scale", None)
+    scale = float(scale) if scale else None
+    if scale is not None and not 0 < scale <= 1:
+        raise ValueError("scale should be 0~1")
+    max_side = get_argument("max_side", None)
+    max_side = int(max_side) if max_side else None
+    if max_side is not None and max_side <= 0:
+        raise ValueError("max_side should be positive")
+    grayscale = get_argument("grayscale", "false").lower() in ("1", "true", "yes")
+    return ImageOptions("jpeg" if fmt == "jpg" else fmt, quality, scale, max_side, grayscale)
+
+
+def is_plain_jpeg(options: ImageOptions) -> bool:
+    """json接口或未指定质量、尺寸、灰度的jpeg请求 已有的jpeg画面可以直接返回"""
+    return options == JSON_OPTIONS or (options.format == "jpeg" and options.quality is None and not (
+        options.scale or options.max_side or options.grayscale))
+
+
+def content_type(options: ImageOptions) -> str:
+    return FORMATS[options.format][1]
+
+
+def resize(image: Image.Image, options: ImageOptions) -> Image.Image:
+    """先缩小再编码 编码耗时和输出大小都与像素数成正比"""
+    width, height = image.size
+    ratio = options.scale or 1.0
+    if options.max_side:
+        ratio = min(ratio, options.max_side / max(width, height))
+    if ratio >= 1:
+        return image
+    size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+    return image.resize(size, Image.BILINEAR)
+
+
+def encode_image(image: Image.Image, options: ImageOptions = DEFAULT_OPTIONS) -> bytes:
+    image = resize(image, options)
+    image = image.convert("L" if options.grayscale else "RGB")
+    buffer = io.BytesIO()
+    pil_format = FORMATS[options.format][0]
+    if pil_format == "PNG":
+        # png无损 quality不生效 使用较低压缩级别换取速度
+        image.save(buffer, format=pil_format, compress_level=1)
+    else:
+        image.save(buffer, format=pil_format, quality=options.quality or DEFAULT_QUALITY)
+    return buffer.getvalue()
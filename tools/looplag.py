@@ -0,0 +1,57 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import sys
+import threading
+import time
+import traceback
+
+from logzero import logger
+from tornado.ioloop import IOLoop
+
+
+class LoopLagMonitor(object):
+    """
+    事件循环卡顿监控
+    IOLoop定时更新心跳 后台线程发现心跳超过阈值未更新时 打印IOLoop线程当前的调用栈
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread_id = None
+        self._callback = None
+        self._thread = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._callback = IOLoop.current().call_later(self.interval, self._heartbeat)
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        lag = now - self._beat - self.interval
+        if lag > self.threshold:
+            logger.warning("IOLoop blocked for %.3fs", lag)
+        self._beat = now
+        self._callback = IOLoop.current().call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            if time.monotonic() - beat - self.interval < self.threshold or reported == beat:
+                continue
+            # 同一次卡顿只打印一次调用栈
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning("IOLoop blocked over %.3fs, current stack:\n%s", self.threshold, stack)
@@ -0,0 +1,101 @@
+# coding: utf-8
+# copyright by Chras-fu of liuma
+
+import asyncio
+import time
+
+
+class ScreenshotCache(object):
+    """
+    单台设备的截图缓存
+    并发请求共享同一次截图和编码 ttl大于0时 ttl内的截图和编码结果直接复用
+    截图与编码参数无关 不同编码参数的请求在ttl内也只截图一次
+    截图分辨率可能不满足所有编码参数 由accept判断共享的截图能否使用
+    """
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 等待进行中的截图或编码的次数
+        self.shared = 0
+        self.captures = 0
+        self._frame = None
+        self._frame_time = 0
+        self._capturing = None
+        # 编码参数 -> (截图时间, 编码结果)
+        self._encoded = dict()
+        self._encoding = dict()
+
+    def _fresh(self, timestamp: float) -> bool:
+        return self.ttl > 0 and time.monotonic() - timestamp <= self.ttl
+
+    async def get(self, key, capture, encode, accept=None):
+        """
+        key: 编码参数 需可哈希
+        capture: 返回截图的协程函数
+        encode: 编码截图的协程函数 encode(image)
+        accept: 判断截图能否用于本次编码的函数 accept(image) 为None时均可使用
+        """
+        entry = self._encoded.get(key)
+        if entry and self._fresh(entry[0]):
+            self.hits += 1
+            return entry[1]
+        future = self._encoding.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.ensure_future(self._produce(key, capture, encode, accept))
+        self._encoding[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._encoding.get(key) is future:
+                self._encoding.pop(key)
+
+    async def _produce(self, key, capture, encode, accept=None):
+        timestamp, image = await self.frame(capture, accept)
+        data = await encode(image)
+        if self.ttl > 0:
+            for stale in [k for k, (t, _) in self._encoded.items() if not self._fresh(t)]:
+                self._encoded.pop(stale)
+            self._encoded[key] = (timestamp, data)
+        return data
+
+    async def frame(self, capture, accept=None) -> tuple:
+        """返回(截图时间, 截图) 同一时刻只有一次截图在进行 共享的截图不被accept接受时单独截图"""
+        if self._frame is not None and self._fresh(self._frame_time) and (accept is None or accept(self._frame)):
+            return self._frame_time, self._frame
+        if self._capturing is None:
+            self._capturing = asyncio.ensure_future(self._capture(capture))
+        future = self._capturing
+        try:
+            timestamp, image = await asyncio.shield(future)
+        finally:
+            if self._capturing is future and future.done():
+                self._capturing = None
+        if accept is not None and not accept(image):
+            return await self._capture(capture)
+        return timestamp, image
+
+    async def _capture(self, capture) -> tuple:
+        self.captures += 1
+        image = await capture()
+        timestamp = time.monotonic()
+        if self.ttl > 0:
+            self._frame, self._frame_time = image, timestamp
+        return timestamp, image
+
+    def clear(self):
+        self._frame = None
+        self._encoded.clear()
+
+    def as_dict(self) -> dict:
+        return {
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "captures": self.captures,
+        }